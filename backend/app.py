@@ -1,35 +1,668 @@
 import schedule
+import atexit
 import threading
 import time
-from flask import Flask, request, jsonify
+import queue
+import heapq
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
 import os
-from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import ReturnDocument, UpdateOne, CursorType
+from pymongo.errors import BulkWriteError, CollectionInvalid
 from bson import json_util  # To handle JSON serialization
 from datetime import datetime
 import json
-from openai import OpenAI
+import base64
+import hashlib
+import functools
+import contextvars
+import logging
+import uuid
 from flask_cors import CORS  # Import CORS
 from bson import ObjectId
 from datetime import timedelta
+from collections import OrderedDict
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from storage import (
+    goals_collection, subtasks_collection, tombstones_collection, llm_cache_collection,
+    jobs_collection, idempotency_collection, leases_collection, events_collection, LLM_CACHE_TTL, IDEMPOTENCY_TTL, ensure_indexes, insert_documents,
+    next_change_seq, current_change_seq, parse_deadline
+)
+from llm import LLMGateway, LLMUnavailableError, LLMTimeoutError, CircuitOpenError
+from lease import Lease
+from prompts import PromptBuilder, Field, summarize_history, truncate_to_tokens
+from history import (
+    new_history_entry, recent_history_update, append_history, set_history_field, delete_history,
+    decode_history_cursor, read_history, HISTORY_KINDS
+)
+from idempotency import SingleFlight, IdempotencyStore
+from jsonstream import JSONArrayParser
+from stats import stats_operation, record_stats, read_stats, completion_counts, stats_day
+from metrics import (
+    HTTP_REQUEST_DURATION, JOB_DURATION, SSE_CLIENTS, LLM_CIRCUIT_OPEN, SUBMISSIONS_COALESCED, render_metrics
+)
+from logs import configure_logging, start_request_context, clear_request_context, log_context
+
+try:
+    import orjson  # Optional, several times faster than the stdlib encoder for large lists
+except ImportError:
+    orjson = None
+
+
+def json_default(value):
+    """Serialize values the json module cannot: dates as ISO-8601, anything else (e.g. ObjectId) as a string."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class BSONJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that understands ObjectId and datetime natively.
+
+    Documents straight from MongoDB can be encoded without first copying them
+    to convert ids. Uses orjson when it is installed and the stdlib encoder
+    otherwise; both render dates as ISO-8601.
+    """
+
+    @staticmethod
+    def default(value):
+        return json_default(value)
 
-# Load environment variables
-load_dotenv()
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+# Log through a background writer thread instead of printing on the request thread
+configure_logging()
+logger = logging.getLogger("pk-agent.app")
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 CORS(app, origins=["http://localhost:3000"])  # Enable CORS for all routes
 
-# Configure MongoDB client
-mongo_uri = os.getenv("MONGO_URI")
-mongo_client = MongoClient(mongo_uri)
-db = mongo_client["pk-agent"]  # Database name
-tasks_collection = db["tasks"]  # Collection for storing tasks
-
-# Configure OpenAI client with DeepSeek base URL
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com"
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+DEEPSEEK_MODEL = "deepseek-chat"
+
+# Seconds each call site's LLM call may take in total, across retries and hedges.
+# The call site names also label the LLM metrics.
+LLM_DEADLINES = {
+    "add_task": 60,
+    "add_tasks": 45,  # Per goal of a batch
+    "generate_subtasks": 60,
+    "check_in_endpoint": 20,
+    "analyze_reason_endpoint": 20,
+    "generate_motivation": 20,
+    "generate_motivation_batch": 90,
+}
+# Input and output token budgets per call site. Prompts are compacted to fit the
+# input budget and replies are capped at the output budget.
+LLM_TOKEN_BUDGETS = {
+    "add_task": {"input": 600, "output": 900},
+    "add_tasks": {"input": 600, "output": 900},
+    "generate_subtasks": {"input": 600, "output": 1000},
+    "check_in_endpoint": {"input": 600, "output": 400},
+    "analyze_reason_endpoint": {"input": 800, "output": 500},
+    "generate_motivation": {"input": 800, "output": 500},
+    "generate_motivation_batch": {"input": 1500, "output": 1500},
+}
+# Interactive call sites that send a backup request when the first one is unusually slow
+LLM_HEDGED_ROUTES = {"check_in_endpoint", "analyze_reason_endpoint", "generate_motivation"}
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# All LLM calls share one gateway: connection pool, deadlines, retries and circuit breaker
+llm_gateway = LLMGateway(
+    api_key=os.getenv("DEEPSEEK_API_KEY"),
+    base_url=DEEPSEEK_BASE_URL,
+    model=DEEPSEEK_MODEL,
+    deadlines=LLM_DEADLINES,
+    hedged_routes=LLM_HEDGED_ROUTES,
+    output_budgets={route: budget["output"] for route, budget in LLM_TOKEN_BUDGETS.items()},
+    max_concurrency=LLM_MAX_CONCURRENCY
 )
+prompt_builder = PromptBuilder(LLM_TOKEN_BUDGETS)
+
+# Longest user-supplied text and motivation tips included in a prompt
+PROMPT_GOAL_TOKENS = 200
+PROMPT_TASK_TOKENS = 100
+PROMPT_REASON_TOKENS = 150
+PROMPT_TIPS_TOKENS = 80
+PROMPT_HISTORY_TOKENS = 150
+
+# Prompt template versions, part of the LLM cache key. Bump one whenever its
+# prompt changes so responses to the old wording are no longer served.
+ADD_TASK_PROMPT_VERSION = "add-task-v2"
+GENERATE_SUBTASKS_PROMPT_VERSION = "generate-subtasks-v2"
+
+# LLM response cache settings
+LLM_CACHE_SIZE = 512  # Entries kept in the in-process tier
+
+
+# Documents read from a cursor and encoded per chunk of a streamed response
+STREAM_BATCH_SIZE = 200
+
+
+def cursor_batches(cursor, size=STREAM_BATCH_SIZE):
+    """Yield lists of up to `size` documents, fetching them from MongoDB in batches of the same size."""
+    cursor = iter(cursor.batch_size(size))
+    while True:
+        batch = list(islice(cursor, size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_json_array(batches, prefix="[", suffix="]"):
+    """
+    Encode a JSON array chunk by chunk, one batch of items at a time.
+
+    Only one batch is held and encoded at once, so memory and time to first
+    byte do not grow with the length of the list. `prefix` and `suffix` wrap
+    the array, so it can also be a member of an enclosing object; `suffix`
+    may be a callable that is evaluated once every batch has been sent.
+    """
+    batches = iter(batches)
+    # Fetch the first batch before the response starts, so query errors can still become a 500
+    first_batch = next(batches, [])
+
+    def generate():
+        yield prefix
+        first = True
+        for batch in chain([first_batch], batches):
+            if not batch:
+                continue
+            # Encode the batch as one array and splice its items into the stream
+            items = app.json.dumps(batch)[1:-1]
+            yield items if first else "," + items
+            first = False
+        yield suffix() if callable(suffix) else suffix
+
+    return generate()
+
+
+# Change sequences re-read by a delta sync before its `since` token. A sequence
+# is allocated before its write is applied, so a reader can see N+1 while the
+# row stamped N is still in flight; the overlap picks such rows up next time.
+SYNC_OVERLAP_SEQS = 100
+
+
+def list_etag(*row_sets, sizes=()):
+    """
+    Build the ETag for a list response from the rows it contains and the request URL.
+
+    Each row set is an iterable of documents with an _id and, if they change,
+    an updated_seq. The tag covers exactly the rows served, so a write that
+    becomes visible after a later one still changes it. `sizes` are document
+    counts to cover as well, for tags built from recent_changes.
+    """
+    digest = hashlib.sha1(request.full_path.encode())
+    for rows in row_sets:
+        for row in rows:
+            digest.update(f"|{row['_id']}:{row.get('updated_seq')}".encode())
+        digest.update(b"#")
+    for size in sizes:
+        digest.update(f"|{size}".encode())
+    return digest.hexdigest()
+
+
+def recent_changes(collection):
+    """
+    Return the _id and updated_seq of a collection's latest changes, read through its updated_seq index.
+
+    These are the rows changed within SYNC_OVERLAP_SEQS of the newest change,
+    so a write that becomes visible after a later one still shows up, as it
+    does in delta sync. With the collection's size, which catches deletions,
+    they tag a whole-collection listing without reading every row.
+    """
+    newest = collection.find_one({}, {"updated_seq": 1}, sort=[("updated_seq", -1)])
+    if not newest or newest.get("updated_seq") is None:
+        return []
+    return collection.find(
+        {"updated_seq": {"$gt": newest["updated_seq"] - SYNC_OVERLAP_SEQS}}, {"updated_seq": 1}
+    ).sort("_id", 1)
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already holds the representation tagged `etag`."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+# Server-sent event settings
+SSE_QUEUE_SIZE = 100  # Events buffered per client before it is asked to resync
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_CLIENTS = 50  # Per process; create_app lowers it to a share of a threaded worker's threads
+SSE_THREAD_SHARE = 0.5  # Share of a worker's request threads that /events streams may hold
+
+
+class EventBroker:
+    """
+    Fan out server-sent events to every connected /events client.
+
+    Each client gets its own bounded queue. Publishers never block: when a
+    client falls too far behind, its backlog is replaced by a single `resync`
+    event telling it to fetch the changes it missed with a delta sync.
+    """
+
+    def __init__(self, queue_size=SSE_QUEUE_SIZE, max_clients=SSE_MAX_CLIENTS):
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.relay = None  # EventRelay sharing events with other processes, if any
+
+    def subscribe(self):
+        """Register a new client queue, or return None if the broker is full."""
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                return None
+            client_queue = queue.Queue(maxsize=self.queue_size)
+            self.subscribers.add(client_queue)
+            return client_queue
+
+    def unsubscribe(self, client_queue):
+        with self.lock:
+            self.subscribers.discard(client_queue)
+
+    def client_count(self):
+        with self.lock:
+            return len(self.subscribers)
+
+    def publish(self, event, data):
+        """Queue an event for every connected client, in this process and, through the relay, in others."""
+        message = f"event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n"
+        self.deliver(message)
+        if self.relay is not None:
+            self.relay.forward(message)
+
+    def deliver(self, message):
+        """Queue an already formatted event for the clients connected to this process."""
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for client_queue in subscribers:
+            try:
+                client_queue.put_nowait(message)
+            except queue.Full:
+                # Drop the backlog; the client catches up with a delta sync instead
+                while True:
+                    try:
+                        client_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                try:
+                    client_queue.put_nowait("event: resync\ndata: {}\n\n")
+                except queue.Full:
+                    pass
+
+
+event_broker = EventBroker()
+
+
+# Event relay settings
+EVENT_RELAY_BYTES = 16 * 1024 * 1024  # Size of the capped collection; old events are overwritten
+EVENT_RELAY_RETRY_SECONDS = 1
+
+
+class EventRelay:
+    """
+    Share server-sent events between the worker processes of one deployment.
+
+    Every event published in a process is also written to a capped
+    collection, and each process tails that collection to deliver the events
+    of the other processes to its own clients. If the tail is lost, e.g.
+    because the collection wrapped around faster than it was read, clients
+    are sent a `resync` event and catch up with a delta sync.
+    """
+
+    def __init__(self, broker, collection, size=EVENT_RELAY_BYTES):
+        self.broker = broker
+        self.collection = collection
+        self.size = size
+        self.origin = uuid.uuid4().hex
+
+    def ensure_collection(self):
+        try:
+            self.collection.database.create_collection(self.collection.name, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass  # Created by another process
+
+    def forward(self, message):
+        try:
+            self.collection.insert_one({"origin": self.origin, "message": message, "created_at": datetime.now()})
+        except Exception as e:
+            logger.error("Error relaying event: %s", e)
+
+    def run(self):
+        while True:
+            tailing = False
+            try:
+                # Start at the current end: events published before are not replayed
+                last = self.collection.find_one(sort=[("$natural", -1)])
+                skip_until, started_at = (last["_id"] if last else None), datetime.now()
+                cursor = self.collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for document in cursor:
+                        if skip_until is not None:
+                            if document["_id"] == skip_until:
+                                skip_until = None
+                                continue
+                            if document["created_at"] < started_at:
+                                continue
+                            skip_until = None  # The old end was overwritten before the tail reached it
+                        tailing = True
+                        if document["origin"] != self.origin:
+                            self.broker.deliver(document["message"])
+            except Exception as e:
+                logger.error("Error tailing the event relay: %s", e)
+            # A tailable cursor dies on an empty collection, and when the collection wraps around past it
+            if tailing:
+                # Events published until the tail is re-established are missed
+                self.broker.deliver("event: resync\ndata: {}\n\n")
+            time.sleep(EVENT_RELAY_RETRY_SECONDS)
+
+
+def normalize_goal_text(text):
+    """Normalize goal text for cache lookups: case-insensitive, whitespace collapsed."""
+    return " ".join(text.lower().split())
+
+
+def strip_json_fences(text):
+    """Remove the markdown code block markers the model sometimes wraps JSON in."""
+    cleaned = text.strip()
+    if cleaned.startswith('```json'):
+        cleaned = cleaned[7:]
+    if cleaned.endswith('```'):
+        cleaned = cleaned[:-3]
+    return cleaned.strip()
+
+
+def is_json_response(text):
+    """Return True if an LLM response parses as JSON once its fences are stripped."""
+    try:
+        json.loads(strip_json_fences(text))
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+class LLMResponseCache:
+    """
+    Two-tier cache of raw LLM responses.
+
+    Entries are keyed on normalized goal text, prompt template version and
+    model. Lookups go to an in-process LRU first and then to a MongoDB
+    collection whose TTL index evicts old entries. Only the raw response text
+    is stored, so every hit is parsed again and gets fresh ids and deadlines
+    relative to the time of the request.
+    """
+
+    def __init__(self, collection, max_entries=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "mongo_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(goal_text, prompt_version, model):
+        raw = "\x1f".join([normalize_goal_text(goal_text), prompt_version, model])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None on a miss."""
+        now = datetime.now()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[0]
+
+        # TTL eviction in MongoDB is lazy, so check the age here as well
+        doc = self.collection.find_one({"_id": key, "created_at": {"$gt": now - self.ttl}})
+        with self.lock:
+            if doc:
+                self.stats["mongo_hits"] += 1
+                self._remember(key, doc["response"], doc["created_at"])
+                return doc["response"]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, response):
+        created_at = datetime.now()
+        with self.lock:
+            self._remember(key, response, created_at)
+        try:
+            self.collection.replace_one(
+                {"_id": key},
+                {"response": response, "created_at": created_at},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error("Error writing LLM cache entry: %s", e)
+
+    def _remember(self, key, response, created_at):
+        self.entries[key] = (response, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "memory_entries": len(self.entries)}
+
+
+llm_cache = LLMResponseCache(llm_cache_collection)
+# Concurrent cache misses for the same key wait for one LLM call instead of each making their own
+llm_flights = SingleFlight()
+
+
+def cached_completion(route, goal_text, prompt_version, messages, validate=is_json_response, **kwargs):
+    """
+    Return the model's reply to `messages`, served from llm_cache when possible.
+
+    Only replies accepted by `validate` are cached, so a malformed response is
+    never replayed to later requests. `route` names the call site, which picks
+    its LLM deadline and labels its metrics.
+    """
+    key = llm_cache.make_key(goal_text, prompt_version, DEEPSEEK_MODEL)
+    content = llm_cache.get(key)
+    if content is not None:
+        return content
+
+    def fetch():
+        content = llm_gateway.complete(route, messages, **kwargs)
+        if validate(content):
+            llm_cache.put(key, content)
+        return content
+
+    content, _ = llm_flights.do(key, fetch)
+    return content
+
+
+def wants_streaming():
+    """True if the client asked for the LLM reply as a server-sent event stream."""
+    if parse_bool_arg(request.args.get("stream")):
+        return True
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+
+def stream_completion(route, messages, on_complete, precomputed=None, **kwargs):
+    """
+    Forward the model's reply to the client as server-sent events while it is generated.
+
+    Each chunk is sent as a `data: {"text": ...}` event. Once the reply is
+    complete, `on_complete(text)` persists it and its return value is sent as
+    the final `done` event. Failures are reported as an `error` event because
+    the 200 status has already been sent by then. A `precomputed` reply is sent
+    as a single chunk without calling the model.
+    """
+    def generate():
+        parts = []
+        try:
+            if precomputed is not None:
+                stream = [precomputed]
+            else:
+                stream = llm_gateway.stream(route, messages, **kwargs)
+            for delta in stream:
+                if delta:
+                    parts.append(delta)
+                    yield f"data: {json.dumps({'text': delta})}\n\n"
+
+            summary = on_complete("".join(parts)) or {}
+            yield f"event: done\ndata: {json.dumps(summary, default=json_default)}\n\n"
+
+        except Exception as e:
+            logger.error("Error streaming completion: %s", e)
+            yield f"event: error\ndata: {json.dumps({'error': 'Failed to generate response'})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+def tips_field(task, max_tokens=PROMPT_TIPS_TOKENS):
+    """The task's motivation tips as a prompt field, keeping as many as fit."""
+    tips = task.get("motivation_tips") or []
+    if not isinstance(tips, list):
+        tips = [tips]
+    return Field("tips", tips, max_tokens, separator="; ")
+
+
+def history_field(task, max_tokens=PROMPT_HISTORY_TOKENS):
+    """A summary of the task's check-ins and progress notes as a prompt field."""
+    lines = summarize_history(task.get("check_ins"), task.get("progress_notes"), task.get("history_counts"))
+    return Field("history", lines, max_tokens, empty="no earlier updates")
+
+
+# Idempotency-Key settings for the endpoints that create goals
+IDEMPOTENCY_LEASE = timedelta(minutes=2)  # A claim not renewed for this long is taken over by a retry
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+REPLAYED_HEADERS = ("Location", "Retry-After")
+
+submission_flights = SingleFlight()
+idempotency_store = IdempotencyStore(idempotency_collection, IDEMPOTENCY_TTL, IDEMPOTENCY_LEASE)
+
+
+def request_fingerprint():
+    """Hash what makes two submissions the same request: route, query arguments, Prefer header and JSON body."""
+    raw = json.dumps([
+        request.url_rule.rule,
+        sorted(request.args.items(multi=True)),
+        request.headers.get("Prefer", ""),
+        request.get_json(silent=True)
+    ], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def capture_response(rv):
+    """Turn a view's return value into a plain dict that can be stored, shared between threads and replayed."""
+    response = app.make_response(rv)
+    return {
+        "status": response.status_code,
+        "mimetype": response.mimetype,
+        "body": response.get_data(as_text=True),
+        "headers": {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+    }
+
+
+def coalesce_submissions(view=None, streaming=False):
+    """
+    Answer duplicate submissions to a POST endpoint from one run of `view`.
+
+    Identical requests that arrive while one is in flight in this process
+    wait for it and get its response. With an Idempotency-Key header the
+    response is also stored and replayed to retries of the same request for
+    IDEMPOTENCY_TTL, from any process. Reusing a key for a different request
+    is a 422, and a key still being processed elsewhere is a 409; the claim
+    on the key is renewed while the request runs, however long it takes.
+    Server errors are not stored, so the request can be retried. Shared and replayed
+    responses carry an `Idempotent-Replayed: true` header.
+
+    Use it as @coalesce_submissions, or as @coalesce_submissions(streaming=True)
+    on endpoints that can stream their reply. On those, requests for a
+    streamed reply (see wants_streaming) are passed straight through: their
+    events are sent while they are produced, so there is no finished
+    response to share or replay.
+    """
+    if view is None:
+        return functools.partial(coalesce_submissions, streaming=streaming)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if streaming:
+            try:
+                if wants_streaming():
+                    return view(*args, **kwargs)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        key = request.headers.get("Idempotency-Key")
+        if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({"error": f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"}), 400
+        route = request.url_rule.rule
+        fingerprint = request_fingerprint()
+
+        def run():
+            """Return (captured response, replayed from the store)."""
+            if key is None:
+                return capture_response(view(*args, **kwargs)), False
+
+            store_key = f"{route}:{key}"
+            claimed, record = idempotency_store.claim(store_key, fingerprint)
+            if not claimed:
+                if record["fingerprint"] != fingerprint:
+                    return capture_response((jsonify({
+                        "error": "Idempotency-Key was already used for a different request"
+                    }), 422)), False
+                if record["status"] != "completed":
+                    return capture_response((jsonify({
+                        "error": "A request with this Idempotency-Key is still being processed"
+                    }), 409, {"Retry-After": "5"})), False
+                return record["response"], True
+
+            finished = threading.Event()
+            threading.Thread(
+                target=idempotency_store.renew, args=(store_key, fingerprint, finished), daemon=True
+            ).start()
+            try:
+                captured = capture_response(view(*args, **kwargs))
+            except Exception:
+                idempotency_store.release(store_key)
+                raise
+            finally:
+                finished.set()
+            if captured["status"] < 500:
+                idempotency_store.complete(store_key, captured)
+            else:
+                idempotency_store.release(store_key)
+            return captured, False
+
+        (captured, replayed), shared = submission_flights.do((route, key, fingerprint), run)
+        response = Response(
+            captured["body"], status=captured["status"], mimetype=captured["mimetype"], headers=captured["headers"]
+        )
+        if shared or replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+            SUBMISSIONS_COALESCED.inc(route=route, source="stored" if replayed else "in_flight")
+            logger.info("Answered a duplicate submission", extra={"replayed_from": "store" if replayed else "in_flight"})
+        return response
+
+    return wrapper
 
 
 def parse_relative_deadline(deadline_str):
@@ -49,18 +682,61 @@ def parse_relative_deadline(deadline_str):
     return deadline
 
 
+def default_subtasks(parent_task):
+    """Canned breakdown used when the model's reply cannot be parsed or the LLM is unavailable."""
+    return [{
+        'task': f"Work on {parent_task}",
+        'time_required': '2 hours',
+        'estimated_hours': 2,
+        'deadline': datetime.now() + timedelta(days=1),
+        'parent_goal': parent_task,
+        'parent_goal_id': str(ObjectId()),  # Generate a new ObjectId for the parent goal
+        'completed': False,
+        'completed_at': None,
+        'status': 'pending',
+        'motivation_tips': ['Break the task into smaller steps', 'Take regular breaks'],
+        'checkpoints': ['Start the task', 'Complete 50%', 'Review and finalize'],
+        'check_ins': []
+    }]
+
+
+def subtask_from_breakdown_item(subtask_data, parent_task):
+    """Turn one element of the model's breakdown array into a subtask."""
+    # Convert relative deadline to absolute date
+    deadline = parse_relative_deadline(subtask_data.get('deadline', 'in 1 day'))
+    
+    # Get time required string or generate from estimated hours
+    time_required = subtask_data.get('time_required')
+    if not time_required and 'estimated_hours' in subtask_data:
+        hours = float(subtask_data['estimated_hours'])
+        if hours >= 24:
+            days = hours / 24
+            time_required = f"{int(days)} days"
+        else:
+            time_required = f"{int(hours)} hours"
+    
+    return {
+        'task': subtask_data.get('task', ''),
+        'time_required': time_required or '1 hour',
+        'estimated_hours': float(subtask_data.get('estimated_hours', 1)),
+        'deadline': deadline,
+        'parent_goal': parent_task,
+        'parent_goal_id': str(ObjectId()),  # Generate a new ObjectId for the parent goal
+        'completed': False,
+        'completed_at': None,
+        'status': 'pending',
+        'motivation_tips': subtask_data.get('motivation_tips', []),
+        'checkpoints': subtask_data.get('checkpoints', []),
+        'check_ins': []
+    }
+
+
 def parse_breakdown_to_subtasks(breakdown, parent_task):
     """Parse the OpenAI response into structured subtasks."""
     try:
         # Clean the response by removing markdown code block markers and any leading/trailing whitespace
-        cleaned_response = breakdown.strip()
-        if cleaned_response.startswith('```json'):
-            cleaned_response = cleaned_response[7:]
-        if cleaned_response.endswith('```'):
-            cleaned_response = cleaned_response[:-3]
-        cleaned_response = cleaned_response.strip()
-        
-        print(f"Cleaned response for parsing: {cleaned_response}")
+        cleaned_response = strip_json_fences(breakdown)
+        logger.debug("Parsing breakdown", extra={"response_chars": len(cleaned_response)})
         
         # Parse the cleaned JSON response
         subtasks_data = json.loads(cleaned_response)
@@ -69,66 +745,69 @@ def parse_breakdown_to_subtasks(breakdown, parent_task):
         if not isinstance(subtasks_data, list):
             subtasks_data = [subtasks_data]
         
-        # Process each subtask
-        subtasks = []
-        for subtask_data in subtasks_data:
-            # Convert relative deadline to absolute date
-            deadline = parse_relative_deadline(subtask_data.get('deadline', 'in 1 day'))
-            
-            # Get time required string or generate from estimated hours
-            time_required = subtask_data.get('time_required')
-            if not time_required and 'estimated_hours' in subtask_data:
-                hours = float(subtask_data['estimated_hours'])
-                if hours >= 24:
-                    days = hours / 24
-                    time_required = f"{int(days)} days"
-                else:
-                    time_required = f"{int(hours)} hours"
-            
-            subtask = {
-                'task': subtask_data.get('task', ''),
-                'time_required': time_required or '1 hour',
-                'estimated_hours': float(subtask_data.get('estimated_hours', 1)),
-                'deadline': deadline.isoformat(),
-                'parent_goal': parent_task,
-                'parent_goal_id': str(ObjectId()),  # Generate a new ObjectId for the parent goal
-                'completed': False,
-                'completed_at': None,
-                'status': 'pending',
-                'motivation_tips': subtask_data.get('motivation_tips', []),
-                'checkpoints': subtask_data.get('checkpoints', []),
-                'check_ins': []
-            }
-            subtasks.append(subtask)
-        
-        return subtasks
+        return [subtask_from_breakdown_item(subtask_data, parent_task) for subtask_data in subtasks_data]
         
     except Exception as e:
-        print(f"Error parsing breakdown: {str(e)}")
-        print(f"Response was: {breakdown}")
+        logger.error("Error parsing breakdown: %s", e)
+        logger.debug("Unparseable breakdown response: %s", breakdown)
         # Return a default subtask if parsing fails
-        return [{
-            'task': f"Work on {parent_task}",
-            'time_required': '2 hours',
-            'estimated_hours': 2,
-            'deadline': (datetime.now() + timedelta(days=1)).isoformat(),
-            'parent_goal': parent_task,
-            'parent_goal_id': str(ObjectId()),  # Generate a new ObjectId for the parent goal
-            'completed': False,
-            'completed_at': None,
-            'status': 'pending',
-            'motivation_tips': ['Break the task into smaller steps', 'Take regular breaks'],
-            'checkpoints': ['Start the task', 'Complete 50%', 'Review and finalize'],
-            'check_ins': []
-        }]
+        return default_subtasks(parent_task)
 
 
-def generate_subtasks(user_input):
+def new_subtask_document(subtask, goal_id, goal, seq, created_at):
     """
-    Use the DeepSeek API to generate subtasks based on the user's input.
+    Build the stored form of a generated subtask.
+
+    Every document in the subtasks collection has this shape, so readers never
+    need to fill in defaults.
     """
-    prompt = f"""
-    The user has the following goal: "{user_input}".
+    motivation_tips = subtask.get("motivation_tips") or []
+    if not isinstance(motivation_tips, list):
+        motivation_tips = [motivation_tips]
+    return {
+        "parent_goal_id": goal_id,
+        "parent_goal": goal,
+        "task": subtask.get("task") or "Untitled Task",
+        "time_required": subtask.get("time_required") or "Not specified",
+        "estimated_hours": subtask.get("estimated_hours", 1),
+        # Stored as a BSON date so deadline filters are index range scans
+        "deadline": parse_deadline(subtask["deadline"]) or created_at + timedelta(weeks=1),
+        "motivation_tips": motivation_tips,
+        "checkpoints": subtask.get("checkpoints") or [],
+        "completed": False,
+        "completed_at": None,
+        "status": "pending",  # pending, in_progress, completed, delayed
+        "check_ins": [],  # Latest HISTORY_RECENT entries; the full history is in the history collection
+        "progress_notes": [],
+        "history_counts": {},
+        "check_in_count": 0,
+        "last_check_in": None,
+        "next_check_at": created_at,
+        "created_at": created_at,
+        "updated_seq": seq
+    }
+
+
+# Subtask fields kept for the scheduler only. They are not served, so writes
+# that change nothing else do not stamp updated_seq.
+SCHEDULER_FIELDS = ("precomputed_motivation", "next_check_at")
+SERVED_SUBTASK_PROJECTION = {field: 0 for field in SCHEDULER_FIELDS}
+
+
+def serialize_subtask(subtask):
+    """Convert a stored subtask into its API representation."""
+    subtask = dict(subtask)
+    subtask["_id"] = str(subtask["_id"])
+    subtask["parent_goal_id"] = str(subtask["parent_goal_id"])
+    for field in SCHEDULER_FIELDS:
+        subtask.pop(field, None)
+    return subtask
+
+
+def generate_subtasks_messages(user_input):
+    """The prompt asking the model to break the user's goal into subtasks."""
+    template = """
+    The user has the following goal: "{goal}".
     Break this goal into smaller, actionable subtasks. For each subtask:
     1. Make it specific and clear
     2. Estimate realistic time required
@@ -145,22 +824,175 @@ def generate_subtasks(user_input):
         }}
     ]
     """
+    return prompt_builder.messages("generate_subtasks", template, [Field("goal", user_input, PROMPT_GOAL_TOKENS)])
+
+
+def generate_subtasks(user_input):
+    """
+    Use the DeepSeek API to generate subtasks based on the user's input.
+    """
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000,
+        breakdown = cached_completion(
+            "generate_subtasks",
+            user_input,
+            GENERATE_SUBTASKS_PROMPT_VERSION,
+            generate_subtasks_messages(user_input),
         )
-        return parse_breakdown_to_subtasks(response.choices[0].message.content, user_input)
+        return parse_breakdown_to_subtasks(breakdown, user_input)
+    except LLMUnavailableError as e:
+        logger.warning("DeepSeek API unavailable, using the default breakdown: %s", e)
+        return default_subtasks(user_input)
     except Exception as e:
-        print(f"Error calling DeepSeek API: {str(e)}")
+        logger.error("Error calling DeepSeek API: %s", e)
         return None
 
 
+# Fields every generated subtask must have before it is stored
+BREAKDOWN_REQUIRED_FIELDS = ("task", "time_required", "deadline", "motivation_tips")
+
+
+def stream_breakdown(goal):
+    """
+    Break `goal` into subtasks as server-sent events, storing each subtask as the model writes it.
+
+    The reply is fed through a JSONArrayParser. Each subtask is stored as
+    soon as its object closes and is then sent as a `subtask` event. The goal
+    is stored with the first subtask and announced in a `goal` event. Each
+    write takes its own change sequence, so a client that syncs during the
+    stream picks up every subtask stored so far.
+
+    If the reply breaks off, the stored subtasks are kept and the `done`
+    event has `complete: false`. If no subtask could be used, the default
+    breakdown is stored, as in the buffered path. A complete, valid reply
+    is cached.
+    """
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, default=json_default)}\n\n"
+
+    def generate():
+        created_at = datetime.now()
+        goal_id = None
+        seq = None
+        stored = []
+        failed = []
+        chunks = None
+
+        def store(subtask):
+            """Store one subtask, and the goal before the first one; return the events to send."""
+            nonlocal goal_id, seq
+            if not all(key in subtask for key in BREAKDOWN_REQUIRED_FIELDS):
+                failed.append({"task": subtask.get("task"), "error": "Missing required fields"})
+                return []
+            events = []
+            seq = next_change_seq()
+            if goal_id is None:
+                goal_id = goals_collection.insert_one({
+                    "goal": goal,
+                    "created_at": created_at,
+                    "status": "active",
+                    "updated_seq": seq
+                }).inserted_id
+                events.append(event("goal", {"goal_id": str(goal_id), "goal": goal, "sync_token": str(seq)}))
+            task_doc = new_subtask_document(subtask, goal_id, goal, seq, created_at)
+            try:
+                subtasks_collection.insert_one(task_doc)
+            except Exception as e:
+                logger.error("Error storing subtask: %s", e)
+                failed.append({"task": task_doc["task"], "error": str(e)})
+                return events
+            stored.append(serialize_subtask(task_doc))
+            events.append(event("subtask", stored[-1]))
+            return events
+
+        try:
+            parser = JSONArrayParser()
+            parts = []
+            key = llm_cache.make_key(goal, GENERATE_SUBTASKS_PROMPT_VERSION, DEEPSEEK_MODEL)
+            cached = llm_cache.get(key)
+            try:
+                if cached is not None:
+                    chunks = [cached]
+                else:
+                    chunks = llm_gateway.stream("generate_subtasks", generate_subtasks_messages(goal))
+                for delta in chunks:
+                    parts.append(delta)
+                    for item, error in parser.feed(delta):
+                        if error is None and not isinstance(item, dict):
+                            error = "Subtask is not an object"
+                        if error is not None:
+                            failed.append({"task": None, "error": error})
+                            continue
+                        try:
+                            subtask = subtask_from_breakdown_item(item, goal)
+                        except Exception as e:
+                            failed.append({"task": item.get("task"), "error": str(e)})
+                            continue
+                        for message in store(subtask):
+                            yield message
+            except LLMUnavailableError as e:
+                logger.warning("DeepSeek API unavailable during a streamed breakdown: %s", e)
+            except Exception as e:
+                if not stored:
+                    raise
+                logger.error("Breakdown stream broke off: %s", e)
+
+            reply = "".join(parts)
+            if not parser.closed:
+                logger.warning("Breakdown reply ended before its array closed", extra={
+                    "response_chars": len(reply), "subtasks_stored": len(stored)
+                })
+            elif cached is None and is_json_response(reply):
+                llm_cache.put(key, reply)
+
+            if not stored:
+                logger.debug("Unparseable breakdown response: %s", reply)
+                for subtask in default_subtasks(goal):
+                    for message in store(subtask):
+                        yield message
+            if not stored:
+                yield event("error", {"error": "Failed to store any subtasks", "failed": failed})
+                return
+
+            yield event("done", {
+                "success": True,
+                "message": f"Successfully created {len(stored)} subtasks",
+                "goal_id": str(goal_id),
+                "subtasks": stored,
+                "failed": failed,
+                "complete": parser.closed,
+                "sync_token": str(seq)
+            })
+
+        except Exception as e:
+            logger.error("Error in streamed task breakdown: %s", e)
+            yield event("error", {"error": "Internal server error"})
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            if stored:
+                check_in_waker.schedule(created_at)
+                event_broker.publish("subtasks_generated", {
+                    "goal_id": str(goal_id),
+                    "goal": goal,
+                    "subtask_ids": [subtask["_id"] for subtask in stored],
+                    "sync_token": str(seq)
+                })
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
 @app.route("/breakdown", methods=["POST"])
+@coalesce_submissions(streaming=True)
 def task_breakdown():
     """
     Endpoint to handle task breakdown requests.
+
+    Accepts an Idempotency-Key header; see coalesce_submissions. With
+    ?stream=true (or Accept: text/event-stream) subtasks are stored and sent
+    one by one while the model writes them; see stream_breakdown.
     """
     try:
         data = request.get_json()
@@ -171,51 +1003,62 @@ def task_breakdown():
         if not goal:
             return jsonify({"error": "Goal is required"}), 400
 
+        if wants_streaming():
+            return stream_breakdown(goal)
+
         subtasks = generate_subtasks(goal)
         if not subtasks:
             return jsonify({"error": "Failed to generate subtasks"}), 500
 
-        # Store tasks in MongoDB with additional fields
-        stored_subtasks = []
+        # Build every task document first, then store them in one batch
+        task_docs = []
+        failed_subtasks = []
         current_time = datetime.now()
+        seq = next_change_seq()
+
+        goal_id = goals_collection.insert_one({
+            "goal": goal,
+            "created_at": current_time,
+            "status": "active",
+            "updated_seq": seq
+        }).inserted_id
         
         for subtask in subtasks:
             # Validate required fields
-            if not all(key in subtask for key in ["task", "time_required", "deadline", "motivation_tips"]):
+            if not all(key in subtask for key in BREAKDOWN_REQUIRED_FIELDS):
+                failed_subtasks.append({"task": subtask.get("task"), "error": "Missing required fields"})
                 continue  # Skip invalid subtasks
                 
-            task_doc = {
-                "task": subtask["task"],
-                "time_required": subtask["time_required"],
-                "deadline": subtask["deadline"],
-                "motivation_tips": subtask["motivation_tips"],
-                "created_at": current_time,
-                "last_check_in": None,
-                "check_in_count": 0,
-                "completed": False,
-                "progress_notes": [],
-                "parent_goal": goal
-            }
-            
-            try:
-                result = tasks_collection.insert_one(task_doc)
-                task_doc["_id"] = str(result.inserted_id)
-                stored_subtasks.append(task_doc)
-            except Exception as e:
-                print(f"Error storing subtask: {str(e)}")
-                continue
+            task_docs.append(new_subtask_document(subtask, goal_id, goal, seq, current_time))
+
+        stored_subtasks, failures = insert_documents(subtasks_collection, task_docs)
+        for failure in failures:
+            logger.error("Error storing subtask: %s", failure["error"])
+            failed_subtasks.append({"task": task_docs[failure["index"]]["task"], "error": failure["error"]})
+        stored_subtasks = [serialize_subtask(task_doc) for task_doc in stored_subtasks]
 
         if not stored_subtasks:
             return jsonify({"error": "Failed to store any subtasks"}), 500
 
+        check_in_waker.schedule(current_time)
+
+        event_broker.publish("subtasks_generated", {
+            "goal_id": str(goal_id),
+            "goal": goal,
+            "subtask_ids": [subtask["_id"] for subtask in stored_subtasks],
+            "sync_token": str(seq)
+        })
+
         return jsonify({
             "success": True,
             "message": f"Successfully created {len(stored_subtasks)} subtasks",
-            "subtasks": stored_subtasks
+            "goal_id": str(goal_id),
+            "subtasks": stored_subtasks,
+            "failed": failed_subtasks
         }), 201
 
     except Exception as e:
-        print(f"Error in task breakdown: {str(e)}")
+        logger.error("Error in task breakdown: %s", e)
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
 
 
@@ -223,36 +1066,53 @@ def task_breakdown():
 def check_in_endpoint():
     """
     Endpoint to trigger a check-in for a task.
+
+    With ?stream=true (or Accept: text/event-stream) the motivation is
+    streamed as it is generated; see stream_completion.
     """
     try:
         task_id = request.json.get("task_id")
         if not task_id:
             return jsonify({"error": "Task ID is required"}), 400
 
+        try:
+            streaming = wants_streaming()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         # Find the task in the database
-        task = tasks_collection.find_one({"_id": ObjectId(task_id)})
+        task = subtasks_collection.find_one({"_id": ObjectId(task_id)})
         if not task:
             return jsonify({"error": "Task not found"}), 404
 
         current_time = datetime.now()
-        deadline = datetime.strptime(task["deadline"], "%Y-%m-%d")
+        deadline = parse_deadline(task.get("deadline"))
+        if deadline is None:
+            raise ValueError(f"Invalid deadline: {task.get('deadline')}")
         time_left = deadline - current_time
 
-        # Update check-in stats
-        tasks_collection.update_one(
+        # Update check-in stats and schedule the next check-in
+        next_check_at = compute_next_check_at(deadline, current_time)
+        subtasks_collection.update_one(
             {"_id": ObjectId(task_id)},
             {
-                "$set": {"last_check_in": current_time},
+                "$set": {
+                    "last_check_in": current_time,
+                    "next_check_at": next_check_at,
+                    "updated_seq": next_change_seq()
+                },
                 "$inc": {"check_in_count": 1}
             }
         )
+        check_in_waker.schedule(next_check_at)
 
         if time_left.days < 0:
             # Task is overdue
-            prompt = f"""
-            The user has missed the deadline for: "{task['task']}"
-            Time overdue: {abs(time_left.days)} days
-            Previous motivation tip: {task['motivation_tips']}
+            template = """
+            The user has missed the deadline for: "{task}"
+            Time overdue: {days} days
+            Previous motivation tips: {tips}
+            Earlier check-ins: {history}
             
             Generate a motivational message that:
             1. Acknowledges the missed deadline without being negative
@@ -262,10 +1122,11 @@ def check_in_endpoint():
             """
         else:
             # Task is upcoming
-            prompt = f"""
-            The user has this upcoming task: "{task['task']}"
-            Time remaining: {time_left.days} days
-            Previous motivation tip: {task['motivation_tips']}
+            template = """
+            The user has this upcoming task: "{task}"
+            Time remaining: {days} days
+            Previous motivation tips: {tips}
+            Earlier check-ins: {history}
             
             Generate a motivational message that:
             1. Creates a sense of urgency without causing stress
@@ -273,30 +1134,60 @@ def check_in_endpoint():
             3. Reminds them of the benefits of completing this task early
             4. Suggests breaking the task into smaller chunks if needed
             """
+        messages = prompt_builder.messages("check_in_endpoint", template, [
+            Field("task", task["task"], PROMPT_TASK_TOKENS),
+            Field("days", abs(time_left.days)),
+            tips_field(task),
+            history_field(task)
+        ])
 
-        try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500,
+        summary = {
+            "message": "Check-in recorded",
+            "task": task["task"],
+            "status": "overdue" if time_left.days < 0 else "upcoming",
+            "days_remaining": time_left.days,
+            "check_in_count": task["check_in_count"] + 1
+        }
+
+        def save_motivation(motivation):
+            # A precomputed message is used at most once
+            subtasks_collection.update_one(
+                {"_id": ObjectId(task_id)},
+                {
+                    "$set": {
+                        "last_motivation": motivation,
+                        "last_motivation_at": datetime.now(),
+                        "updated_seq": next_change_seq()
+                    },
+                    "$unset": {"precomputed_motivation": ""}
+                }
+            )
+            return summary
+
+        precomputed = fresh_precomputed_motivation(task, summary["status"], current_time)
+        if streaming:
+            return stream_completion(
+                "check_in_endpoint",
+                messages,
+                save_motivation,
+                precomputed=precomputed["message"] if precomputed else None
             )
-            motivation = response.choices[0].message.content
 
-            return jsonify({
-                "message": "Check-in recorded",
-                "task": task["task"],
-                "status": "overdue" if time_left.days < 0 else "upcoming",
-                "days_remaining": time_left.days,
-                "motivation": motivation,
-                "check_in_count": task["check_in_count"] + 1
-            })
+        try:
+            if precomputed:
+                motivation = precomputed["message"]
+            else:
+                motivation = llm_gateway.complete("check_in_endpoint", messages)
+            save_motivation(motivation)
+
+            return jsonify({**summary, "motivation": motivation})
 
         except Exception as e:
-            print(f"Error generating motivation: {str(e)}")
+            logger.error("Error generating motivation: %s", e)
             return jsonify({"error": "Failed to generate motivation"}), 500
 
     except Exception as e:
-        print(f"Error during check-in: {str(e)}")
+        logger.error("Error during check-in: %s", e)
         return jsonify({"error": "Failed to perform check-in"}), 500
 
 
@@ -304,6 +1195,9 @@ def check_in_endpoint():
 def analyze_reason_endpoint():
     """
     Endpoint to analyze the user's reason for procrastination and provide motivation.
+
+    With ?stream=true (or Accept: text/event-stream) the analysis is streamed
+    as it is generated; see stream_completion.
     """
     try:
         task_id = request.json.get("task_id")
@@ -311,28 +1205,33 @@ def analyze_reason_endpoint():
         if not task_id or not reason:
             return jsonify({"error": "Task ID and reason are required"}), 400
 
-        task = tasks_collection.find_one({"_id": ObjectId(task_id)})
+        try:
+            streaming = wants_streaming()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        task = subtasks_collection.find_one({"_id": ObjectId(task_id)})
         if not task:
             return jsonify({"error": "Task not found"}), 404
 
         # Store the procrastination reason for future analysis
-        tasks_collection.update_one(
+        noted_at = datetime.now()
+        note = new_history_entry({"type": "procrastination", "reason": reason, "timestamp": noted_at}, noted_at)
+        subtasks_collection.update_one(
             {"_id": ObjectId(task_id)},
             {
-                "$push": {
-                    "progress_notes": {
-                        "type": "procrastination",
-                        "reason": reason,
-                        "timestamp": datetime.now()
-                    }
-                }
+                **recent_history_update("progress_note", note),
+                "$set": {"updated_seq": next_change_seq()}
             }
         )
+        append_history(ObjectId(task_id), "progress_note", note)
+        record_stats(stats_operation(task["parent_goal_id"], noted_at, {"procrastination_notes": 1}, reason=reason))
 
-        prompt = f"""
-        Task: "{task['task']}"
+        template = """
+        Task: "{task}"
         User's reason for not working: "{reason}"
-        Previous motivation tip: {task['motivation_tips']}
+        Previous motivation tips: {tips}
+        Earlier check-ins and reasons: {history}
         
         Analyze this situation and provide:
         1. Understanding of their challenge without judgment
@@ -342,271 +1241,1223 @@ def analyze_reason_endpoint():
         
         Keep the tone supportive and focus on solutions rather than the problem.
         """
+        messages = prompt_builder.messages("analyze_reason_endpoint", template, [
+            Field("task", task["task"], PROMPT_TASK_TOKENS),
+            Field("reason", reason, PROMPT_REASON_TOKENS),
+            tips_field(task),
+            history_field(task)
+        ])
+
+        def save_analysis(analysis):
+            # Attach the analysis to the note recorded above
+            set_history_field(ObjectId(task_id), "progress_note", note["_id"], "response", analysis)
+            return {"message": "Reason analyzed"}
+
+        if streaming:
+            return stream_completion("analyze_reason_endpoint", messages, save_analysis)
 
         try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500,
-            )
-            
-            analysis = response.choices[0].message.content
+            analysis = llm_gateway.complete("analyze_reason_endpoint", messages)
+            save_analysis(analysis)
             return jsonify({
                 "message": "Reason analyzed",
                 "motivation": analysis
             })
 
         except Exception as e:
-            print(f"Error generating analysis: {str(e)}")
+            logger.error("Error generating analysis: %s", e)
             return jsonify({"error": "Failed to analyze reason"}), 500
 
     except Exception as e:
-        print(f"Error analyzing reason: {str(e)}")
+        logger.error("Error analyzing reason: %s", e)
         return jsonify({"error": "Failed to analyze reason"}), 500
 
 
+def subtask_completion_update(completed, seq, now):
+    """
+    Build the update pipeline that marks a subtask (in)complete.
+
+    `completed` is the target state, or None to flip the stored one. All
+    fields of a $set stage are computed from the document as it was before
+    the update, so a flip and the fields derived from it come from the
+    same state in one atomic write.
+    """
+    if completed is None:
+        completed = {"$ne": ["$completed", True]}
+    return [{"$set": {
+        "completed": completed,
+        "completed_at": {"$cond": [completed, now, None]},
+        # Reopening only resets a status that said the subtask was done
+        "status": {"$cond": [
+            completed, "completed", {"$cond": [{"$eq": ["$status", "completed"]}, "pending", "$status"]}
+        ]},
+        # A reopened subtask is re-evaluated by the check-in job straight away
+        "next_check_at": {"$cond": [completed, None, now]},
+        "updated_seq": seq
+    }}]
+
+
 @app.route("/toggle-task/<goal_id>/<task_id>", methods=["POST", "OPTIONS"])
 def toggle_task_completion(goal_id, task_id):
     """
     Toggle the completion status of a specific task
+
+    The flip is a single pipeline update computed from the subtask's stored
+    state, so concurrent toggles never lose an update. Sending
+    {"completed": true/false} sets the state directly instead of flipping it.
     """
     if request.method == "OPTIONS":
         return jsonify({"status": "ok"}), 200
         
     try:
-        print(f"\n=== Toggling Task Completion ===")
-        print(f"Goal ID: {goal_id}")
-        print(f"Task ID: {task_id}")
-        
         # Validate ObjectIds
         if not ObjectId.is_valid(goal_id):
             error_msg = f"Invalid goal_id format: {goal_id}"
-            print(error_msg)
+            logger.error(error_msg)
             return jsonify({"error": error_msg}), 400
             
         if not ObjectId.is_valid(task_id):
             error_msg = f"Invalid task_id format: {task_id}"
-            print(error_msg)
+            logger.error(error_msg)
             return jsonify({"error": error_msg}), 400
+
+        desired = (request.get_json(silent=True) or {}).get("completed")
+        if desired is not None and not isinstance(desired, bool):
+            return jsonify({"error": "completed must be a boolean"}), 400
             
         # Convert string IDs to ObjectId
         goal_obj_id = ObjectId(goal_id)
         task_obj_id = ObjectId(task_id)
-        
-        # Find the goal document
-        goal = tasks_collection.find_one({"_id": goal_obj_id})
-        
-        if not goal:
-            error_msg = f"Goal not found with ID: {goal_id}"
-            print(error_msg)
-            return jsonify({"error": error_msg}), 404
-            
-        print(f"Found goal: {goal.get('goal', 'Untitled')}")
-            
-        # Find and update the specific subtask
-        updated = False
-        if "subtasks" in goal and isinstance(goal["subtasks"], list):
-            for subtask in goal["subtasks"]:
-                subtask_id = subtask.get("_id")
-                if isinstance(subtask_id, ObjectId):
-                    subtask_id = str(subtask_id)
-                elif not isinstance(subtask_id, str):
-                    continue
-                    
-                print(f"Comparing task IDs: {subtask_id} == {task_id}")
-                if subtask_id == task_id:
-                    # Toggle the completed status
-                    subtask["completed"] = not subtask.get("completed", False)
-                    subtask["completed_at"] = datetime.now().isoformat() if subtask["completed"] else None
-                    updated = True
-                    print(f"Updated task completion status to: {subtask['completed']}")
-                    break
-        
-        if not updated:
-            error_msg = f"Task not found with ID: {task_id}"
-            print(error_msg)
-            return jsonify({"error": error_msg}), 404
-            
-        # Update the document in MongoDB
-        result = tasks_collection.update_one(
-            {"_id": goal_obj_id},
-            {"$set": {"subtasks": goal["subtasks"]}}
+        seq = next_change_seq()
+        now = datetime.now()
+
+        # The state before the write gives the new state of a flip and tells the stats whether anything changed
+        previous = subtasks_collection.find_one_and_update(
+            {"_id": task_obj_id, "parent_goal_id": goal_obj_id},
+            subtask_completion_update(desired, seq, now),
+            projection={"completed": 1},
+            return_document=ReturnDocument.BEFORE
         )
-        
-        if result.modified_count == 0:
-            error_msg = "Failed to update task in database"
-            print(error_msg)
-            return jsonify({"error": error_msg}), 500
-            
-        print("Successfully updated task completion status")
+
+        if not previous:
+            if goals_collection.find_one({"_id": goal_obj_id}, {"_id": 1}):
+                error_msg = f"Task not found with ID: {task_id}"
+            else:
+                error_msg = f"Goal not found with ID: {goal_id}"
+            logger.error(error_msg)
+            return jsonify({"error": error_msg}), 404
+
+        completed = desired if desired is not None else previous.get("completed") is not True
+        subtask = {"completed": completed, "completed_at": now if completed else None,
+                   "next_check_at": None if completed else now}
+        record_stats(stats_operation(goal_obj_id, now, completion_counts(previous.get("completed", False), completed)))
+        logger.info("Toggled task", extra={"goal_id": goal_id, "task_id": task_id, "completed": subtask["completed"]})
+        check_in_waker.schedule(subtask.get("next_check_at"))
+        event_broker.publish("task_toggled", {
+            "goal_id": goal_id,
+            "task_id": task_id,
+            "completed": subtask["completed"],
+            "sync_token": str(seq)
+        })
         return jsonify({
             "success": True,
             "message": "Task status updated successfully",
-            "completed": subtask["completed"]
+            "completed": subtask["completed"],
+            "completed_at": subtask.get("completed_at")
         })
         
     except Exception as e:
         error_msg = f"Error toggling task completion: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
 
-def check_tasks_job():
+@app.route("/toggle-tasks", methods=["POST", "OPTIONS"])
+def toggle_tasks_bulk():
     """
-    Scheduled job to check tasks and trigger notifications.
+    Set the completion status of many subtasks, across goals, in one bulk write.
+
+    Expects {"toggles": [{"goal_id": ..., "task_id": ..., "completed": true/false}]}.
+    Bulk toggles must name the target state, since a blind flip cannot be
+    expressed without reading each subtask first. A subtask listed more than
+    once is toggled, announced and counted once, with its last entry.
     """
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
     try:
-        current_time = datetime.now()
-        tasks = list(tasks_collection.find({"completed": False}))
-        
-        for task in tasks:
-            deadline = datetime.strptime(task["deadline"], "%Y-%m-%d")
-            time_left = deadline - current_time
-            
-            # Check if we need to send a notification
-            last_check_in = task.get("last_check_in")
-            hours_since_check_in = float('inf')
-            if last_check_in:
-                hours_since_check_in = (current_time - last_check_in).total_seconds() / 3600
-
-            # Determine if we should trigger a check-in based on urgency
-            should_check_in = (
-                (time_left.days <= 0) or  # Task is overdue
-                (time_left.days <= 1 and hours_since_check_in >= 4) or  # Last day, check every 4 hours
-                (time_left.days <= 3 and hours_since_check_in >= 8) or  # Last 3 days, check every 8 hours
-                (hours_since_check_in >= 24)  # Regular check-in every 24 hours
-            )
+        data = request.get_json()
+        toggles = data.get("toggles") if data else None
+        if not isinstance(toggles, list) or not toggles:
+            return jsonify({"error": "toggles must be a non-empty list"}), 400
+
+        seq = next_change_seq()
+        now = datetime.now()
+        latest = {}
+        errors = []
+        for index, toggle in enumerate(toggles):
+            goal_id = toggle.get("goal_id") if isinstance(toggle, dict) else None
+            task_id = toggle.get("task_id") if isinstance(toggle, dict) else None
+            completed = toggle.get("completed") if isinstance(toggle, dict) else None
+            if not ObjectId.is_valid(goal_id) or not ObjectId.is_valid(task_id):
+                errors.append({"index": index, "error": "Invalid goal_id or task_id"})
+                continue
+            if not isinstance(completed, bool):
+                errors.append({"index": index, "error": "completed must be a boolean"})
+                continue
 
-            if should_check_in:
-                print(f"Triggering check-in for task: {task['task']}")
-                # The actual check-in will be handled by the frontend when it polls
+            # The last entry for a subtask wins, so each one is written, announced and counted once
+            latest.pop(task_id, None)
+            latest[task_id] = {"goal_id": goal_id, "task_id": task_id, "completed": completed}
+
+        applied = list(latest.values())
+        operations = [UpdateOne(
+            {"_id": ObjectId(toggle["task_id"]), "parent_goal_id": ObjectId(toggle["goal_id"])},
+            subtask_completion_update(toggle["completed"], seq, now)
+        ) for toggle in applied]
+
+        # Read the current states so events and stats cover only real changes; they
+        # are approximate when other writes toggle the same subtasks concurrently
+        previous = {}
+        if operations:
+            previous = {
+                (str(subtask["parent_goal_id"]), str(subtask["_id"])): subtask.get("completed", False)
+                for subtask in subtasks_collection.find(
+                    {"_id": {"$in": [ObjectId(toggle["task_id"]) for toggle in applied]}},
+                    {"completed": 1, "parent_goal_id": 1}
+                )
+            }
+
+        matched = modified = 0
+        if operations:
+            try:
+                result = subtasks_collection.bulk_write(operations, ordered=False)
+                matched, modified = result.matched_count, result.modified_count
+            except BulkWriteError as e:
+                matched = e.details.get("nMatched", 0)
+                modified = e.details.get("nModified", 0)
+                for write_error in e.details.get("writeErrors", []):
+                    errors.append({"task_id": applied[write_error["index"]]["task_id"],
+                                   "error": write_error.get("errmsg")})
+
+        if modified:
+            check_in_waker.schedule(now)
+            failed_ids = {error["task_id"] for error in errors if "task_id" in error}
+            stats = []
+            for toggle in applied:
+                key = (toggle["goal_id"], toggle["task_id"])
+                if key not in previous or toggle["task_id"] in failed_ids:
+                    continue  # No such subtask in that goal, or its write failed
+                counts = completion_counts(previous[key], toggle["completed"])
+                if counts:
+                    event_broker.publish("task_toggled", {**toggle, "sync_token": str(seq)})
+                    stats.append(stats_operation(ObjectId(toggle["goal_id"]), now, counts))
+            record_stats(*stats)
+
+        logger.info("Bulk toggle matched %d of %d subtasks", matched, len(toggles))
+        return jsonify({
+            "success": not errors and matched == len(applied),
+            "requested": len(toggles),
+            "matched": matched,
+            "modified": modified,
+            "errors": errors
+        })
 
     except Exception as e:
-        print(f"Error in check_tasks_job: {str(e)}")
+        error_msg = f"Error toggling tasks: {str(e)}"
+        logger.error(error_msg)
+        return jsonify({"error": error_msg}), 500
 
-# Schedule the check-in job
-schedule.every(30).minutes.do(check_tasks_job)
 
+# Check-in scheduling settings
+CHECK_IN_BATCH_SIZE = 100  # Due tasks processed per query
+CHECK_IN_RENOTIFY_INTERVAL = timedelta(minutes=30)  # Repeat notifications for tasks that stay due
+CHECK_IN_SAFETY_INTERVAL = timedelta(minutes=30)  # Longest sleep, covers writes made by other processes
+CHECK_IN_HEAP_SIZE = 1000
 
-# Scheduler setup
-scheduler_started = False
-scheduler_lock = threading.Lock()
 
+def should_check_in(deadline, last_check_in, now):
+    """Apply the urgency rule: the closer the deadline, the more often we check in."""
+    hours_since_check_in = float('inf')
+    if last_check_in:
+        hours_since_check_in = (now - last_check_in).total_seconds() / 3600
+    if deadline is None:
+        return hours_since_check_in >= 24
 
-def run_scheduler():
-    """
-    Function to run the scheduler in a separate thread.
-    """
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    time_left = deadline - now
+    return (
+        (time_left.days <= 0) or  # Task is overdue
+        (time_left.days <= 1 and hours_since_check_in >= 4) or  # Last day, check every 4 hours
+        (time_left.days <= 3 and hours_since_check_in >= 8) or  # Last 3 days, check every 8 hours
+        (hours_since_check_in >= 24)  # Regular check-in every 24 hours
+    )
 
 
-# Start the scheduler in a separate thread
-scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-scheduler_thread.start()
+def compute_next_check_at(deadline, last_check_in, now=None):
+    """
+    Return the earliest time at which should_check_in becomes true.
+
+    Each clause of the urgency rule turns true at a fixed point in time, so the
+    next check is the earliest of those points. Tasks never checked in are due
+    immediately.
+    """
+    now = now or datetime.now()
+    if last_check_in is None:
+        return now
+    if deadline is None:
+        return last_check_in + timedelta(hours=24)
+
+    return min(
+        deadline - timedelta(days=1),
+        max(deadline - timedelta(days=2), last_check_in + timedelta(hours=4)),
+        max(deadline - timedelta(days=4), last_check_in + timedelta(hours=8)),
+        last_check_in + timedelta(hours=24),
+    )
+
+
+def reschedule_after_check(deadline, last_check_in, notified, now):
+    """Pick the next check time for a task the job has just examined."""
+    next_check_at = compute_next_check_at(deadline, last_check_in, now)
+    if notified or next_check_at <= now:
+        next_check_at = max(next_check_at, now + CHECK_IN_RENOTIFY_INTERVAL)
+    return next_check_at
+
+
+def find_due_checks(now):
+    """Return a cursor over incomplete subtasks whose next_check_at has passed, read in bounded batches."""
+    return subtasks_collection.find(
+        {"completed": False, "next_check_at": {"$lte": now}},
+        {"task": 1, "parent_goal_id": 1, "deadline": 1, "last_check_in": 1, "next_check_at": 1}
+    ).sort("next_check_at", 1).batch_size(CHECK_IN_BATCH_SIZE)
+
+
+def earliest_pending_check(now):
+    """Return the earliest future next_check_at of any incomplete subtask."""
+    task = subtasks_collection.find_one(
+        {"completed": False, "next_check_at": {"$gt": now}},
+        {"next_check_at": 1},
+        sort=[("next_check_at", 1)]
+    )
+    return task["next_check_at"] if task else None
+
+
+def timed_job(name):
+    """Record every run of the decorated job in the job duration histogram."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with JOB_DURATION.time(job=name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@timed_job("check_tasks")
+def check_tasks_job():
+    """
+    Scheduled job to check tasks and trigger notifications.
+
+    Only tasks whose precomputed next_check_at has passed are read. Each one is
+    notified if the urgency rule holds and then rescheduled; the update is
+    conditional on the old next_check_at so a repeated run is a no-op.
+    """
+    try:
+        current_time = datetime.now()
+        notified = 0
+
+        for task in find_due_checks(current_time):
+            deadline = parse_deadline(task.get("deadline"))
+            last_check_in = task.get("last_check_in")
+
+            due = should_check_in(deadline, last_check_in, current_time)
+            next_check_at = reschedule_after_check(deadline, last_check_in, due, current_time)
+
+            result = subtasks_collection.update_one(
+                {"_id": task["_id"], "next_check_at": task["next_check_at"]},
+                {"$set": {"next_check_at": next_check_at}}
+            )
+            if result.modified_count == 0:
+                continue  # Checked in or rescheduled concurrently
+
+            if due:
+                notified += 1
+                event_broker.publish("check_in_due", {
+                    "task_id": str(task["_id"]),
+                    "goal_id": str(task["parent_goal_id"]),
+                    "task": task.get("task"),
+                    "deadline": task.get("deadline"),
+                    "overdue": deadline is not None and deadline < current_time
+                })
+
+        logger.info("Check-in job notified %d tasks", notified)
+
+    except Exception as e:
+        logger.error("Error in check_tasks_job: %s", e)
+
+
+class CheckInWaker:
+    """
+    Run check_tasks_job exactly when the next task becomes due.
+
+    Write paths push the next_check_at values they compute onto a min-heap and
+    the waker sleeps until the earliest one. After each run it pushes the
+    earliest pending time from the index, so stale heap entries only cause a
+    harmless extra run. It also runs at least every `safety_interval` to pick
+    up schedules written by other processes. While `is_active()` is false,
+    e.g. in a process that does not hold the scheduler lease, the job is
+    skipped.
+    """
+
+    def __init__(self, job, max_entries=CHECK_IN_HEAP_SIZE, safety_interval=CHECK_IN_SAFETY_INTERVAL,
+                 is_active=lambda: True):
+        self.job = job
+        self.max_entries = max_entries
+        self.safety_interval = safety_interval
+        self.is_active = is_active
+        self.heap = []
+        self.condition = threading.Condition()
+
+    def schedule(self, when):
+        """Make sure the job runs no later than `when`."""
+        if when is None:
+            return
+        with self.condition:
+            if len(self.heap) >= self.max_entries:
+                self.heap = heapq.nsmallest(self.max_entries // 2, self.heap)
+            heapq.heappush(self.heap, when)
+            if self.heap[0] == when:
+                self.condition.notify()
+
+    def run(self):
+        next_safety_run = datetime.now()
+        while True:
+            with self.condition:
+                wake_at = min(self.heap[0], next_safety_run) if self.heap else next_safety_run
+                timeout = (wake_at - datetime.now()).total_seconds()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                now = datetime.now()
+                while self.heap and self.heap[0] <= now:
+                    heapq.heappop(self.heap)
+
+            next_safety_run = datetime.now() + self.safety_interval
+            if not self.is_active():
+                continue
+            self.job()
+            try:
+                self.schedule(earliest_pending_check(datetime.now()))
+            except Exception as e:
+                logger.error("Error loading next check-in time: %s", e)
+
+
+check_in_waker = CheckInWaker(check_tasks_job, is_active=lambda: scheduler_lease.is_held())
+
+
+# Motivation precompute settings
+MOTIVATION_HORIZON = timedelta(hours=2)  # Precompute for tasks whose check-in falls due within this window
+MOTIVATION_TTL = timedelta(hours=6)
+MOTIVATION_BATCH_SIZE = 5  # Tasks per LLM prompt
+MOTIVATION_MAX_TASKS = 50  # Tasks per job run
+MOTIVATION_INTERVAL_MINUTES = 15
+MOTIVATION_CLAIM_TTL = timedelta(minutes=10)  # A run that has not stored its messages by then is retried
+
+
+def fresh_precomputed_motivation(task, status=None, now=None):
+    """Return the task's precomputed motivation if it has not expired and matches `status`."""
+    precomputed = task.get("precomputed_motivation")
+    if not precomputed or not precomputed.get("message"):
+        return None  # Nothing prepared, or only claimed by a job still generating it
+    if precomputed.get("expires_at") is None or precomputed["expires_at"] <= (now or datetime.now()):
+        return None
+    if status is not None and precomputed.get("status") != status:
+        return None
+    return precomputed
+
+
+def generate_motivation_batch(tasks, now):
+    """
+    Ask DeepSeek for check-in messages for several tasks in a single prompt.
+
+    Returns a dict mapping task _id to the generated message fields; tasks
+    the model skipped or mangled are simply missing from it.
+    """
+    lines = []
+    for index, task in enumerate(tasks):
+        deadline = parse_deadline(task.get("deadline"))
+        if deadline is None:
+            timing = "no fixed deadline"
+        elif deadline < now:
+            timing = f"overdue by {abs((deadline - now).days)} days"
+        else:
+            timing = f"{(deadline - now).days} days remaining"
+        tips, _ = tips_field(task, PROMPT_TIPS_TOKENS // 2).fit(PROMPT_TIPS_TOKENS // 2)
+        lines.append(f'{index}. "{truncate_to_tokens(task.get("task", "your task"), PROMPT_TASK_TOKENS // 2)}" '
+                     f'({timing}). Previous motivation tips: {tips}')
+
+    # Tasks whose line does not fit the budget are left out and get no message
+    template = """The user will soon be asked to check in on each of these tasks:
+{tasks}
+
+For each task, write a check-in message that:
+1. Acknowledges a missed deadline without being negative, or creates urgency without causing stress
+2. Provides specific tips to make progress today
+3. Reminds them why finishing this task matters
+
+Return only a JSON array with one object per task, in this format:
+[
+    {{
+        "index": 0,
+        "message": "the check-in message",
+        "suggestions": ["suggestion1", "suggestion2"],
+        "motivation": "A brief motivational message"
+    }}
+]"""
+
+    content = llm_gateway.complete(
+        "generate_motivation_batch",
+        prompt_builder.messages(
+            "generate_motivation_batch",
+            template,
+            [Field("tasks", lines)],
+            system="You are an empathetic productivity coach."
+        ),
+        max_tokens=300 * len(tasks),
+    )
+    results = json.loads(strip_json_fences(content))
+
+    messages = {}
+    for result in results if isinstance(results, list) else []:
+        try:
+            task = tasks[int(result["index"])]
+        except (KeyError, TypeError, ValueError, IndexError):
+            continue
+        if isinstance(result.get("message"), str):
+            messages[task["_id"]] = result
+    return messages
+
+
+@timed_job("precompute_motivations")
+def precompute_motivations_job():
+    """
+    Scheduled job to prepare check-in messages before tasks fall due.
+
+    Tasks are grouped MOTIVATION_BATCH_SIZE to a prompt and each message is
+    stored on its task with an expiry, so check-ins can answer without
+    waiting on the model.
+
+    Tasks are claimed before the model is asked and messages are only stored
+    over this run's claim, so overlapping runs (e.g. while the scheduler
+    lease fails over) never pay twice for a task or overwrite a newer message.
+    """
+    try:
+        now = datetime.now()
+        needs_motivation = {
+            "completed": False,
+            "next_check_at": {"$lte": now + MOTIVATION_HORIZON},
+            "$or": [
+                {"precomputed_motivation": None},
+                {"precomputed_motivation.expires_at": {"$lte": now}}
+            ]
+        }
+        candidates = subtasks_collection.find(needs_motivation, {"_id": 1}) \
+            .sort("next_check_at", 1).limit(MOTIVATION_MAX_TASKS)
+        run_id = ObjectId()
+        subtasks_collection.update_many(
+            {**needs_motivation, "_id": {"$in": [task["_id"] for task in candidates]}},
+            {"$set": {"precomputed_motivation": {"claimed_by": run_id, "expires_at": now + MOTIVATION_CLAIM_TTL}}}
+        )
+        tasks = list(subtasks_collection.find(
+            {"precomputed_motivation.claimed_by": run_id},
+            {"task": 1, "deadline": 1, "motivation_tips": 1}
+        ).sort("next_check_at", 1))
+
+        stored = 0
+        for start in range(0, len(tasks), MOTIVATION_BATCH_SIZE):
+            batch = tasks[start:start + MOTIVATION_BATCH_SIZE]
+            try:
+                messages = generate_motivation_batch(batch, now)
+            except Exception as e:
+                logger.error("Error generating motivation batch: %s", e)
+                continue
+
+            for task in batch:
+                result = messages.get(task["_id"])
+                if not result:
+                    continue
+                deadline = parse_deadline(task.get("deadline"))
+                result = subtasks_collection.update_one(
+                    {"_id": task["_id"], "precomputed_motivation.claimed_by": run_id},
+                    {"$set": {"precomputed_motivation": {
+                        "message": result["message"],
+                        "suggestions": result.get("suggestions") or [],
+                        "motivation": result.get("motivation"),
+                        # check_in_endpoint only serves a message written for the task's current state
+                        "status": "overdue" if deadline is not None and (deadline - now).days < 0 else "upcoming",
+                        "generated_at": now,
+                        "expires_at": now + MOTIVATION_TTL
+                    }}}
+                )
+                stored += result.modified_count
+
+        logger.info("Precomputed motivation for %d of %d tasks", stored, len(tasks))
+
+    except Exception as e:
+        logger.error("Error in precompute_motivations_job: %s", e)
+
+
+# Schedule the motivation precompute job
+schedule.every(MOTIVATION_INTERVAL_MINUTES).minutes.do(precompute_motivations_job)
+
+
+# Scheduler setup: scheduled jobs and the check-in waker run only in the process holding this lease
+SCHEDULER_LEASE_TTL = timedelta(seconds=30)
+SCHEDULER_LEASE_RENEW = timedelta(seconds=10)
+# Longest check-in sleep with several processes, whose writes do not wake the lease holder's waker
+MULTIPROCESS_CHECK_IN_INTERVAL = timedelta(minutes=1)
+
+# The new lease holder checks for due tasks straight away
+scheduler_lease = Lease(
+    leases_collection, "scheduler", SCHEDULER_LEASE_TTL, SCHEDULER_LEASE_RENEW,
+    on_acquired=lambda: check_in_waker.schedule(datetime.now())
+)
+scheduler_started = False
+scheduler_lock = threading.Lock()
+
+
+def run_scheduler():
+    """
+    Function to run the scheduler in a separate thread.
+    """
+    while True:
+        if scheduler_lease.is_held():
+            schedule.run_pending()
+        time.sleep(1)
+
+
+@app.before_request
+def start_request():
+    """Start the latency timer and tag the request's logs with a request id and its route."""
+    g.request_started = time.perf_counter()
+    g.request_id = (request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16])[:64]
+    start_request_context(g.request_id, request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe the request in the latency histogram, labelled by route pattern rather than URL."""
+    started = g.get("request_started")
+    if started is not None:
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            status=response.status_code
+        )
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def end_request(error=None):
+    clear_request_context()
 
 
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', 'http://localhost:3000')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Idempotency-Key')
+    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+    return response
+
+
+# Pagination limits for the flattened subtasks listing
+SUBTASKS_PAGE_SIZE = 100
+SUBTASKS_MAX_PAGE_SIZE = 500
+
+
+def encode_subtasks_cursor(subtask_id):
+    """Encode the id of the last returned subtask as an opaque cursor."""
+    raw = json.dumps({"s": str(subtask_id)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_subtasks_cursor(cursor):
+    """Decode a cursor produced by encode_subtasks_cursor into a subtask ObjectId."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return ObjectId(data["s"])
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def parse_bool_arg(value):
+    """Parse a boolean query string argument, returning None when it is absent."""
+    if value is None:
+        return None
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise ValueError(f"Invalid boolean value: {value}")
+
+
+def parse_due_bound(value, end_of_day=False):
+    """
+    Parse a due_after/due_before query argument into a datetime.
+
+    A bare YYYY-MM-DD upper bound covers the whole day, so due_before=2025-03-01
+    includes subtasks due at any time on March 1st.
+    """
+    if value is None:
+        return None
+    bound = parse_deadline(value)
+    if bound is None:
+        raise ValueError(f"Invalid date: {value}")
+    if end_of_day and len(value.strip()) == 10:
+        bound = bound.replace(hour=23, minute=59, second=59, microsecond=999000)
+    return bound
+
+
+def build_subtasks_query(after=None, completed=None, status=None, due_after=None, due_before=None, since=None,
+                         overdue_at=None):
+    """
+    Build the subtasks collection filter for one page of the listing.
+
+    Every condition is served by an index on the subtasks collection, and the
+    page continues strictly after the `after` id. `overdue_at` restricts the
+    page to open subtasks whose deadline passed before that time, a range scan
+    on the (completed, deadline) index.
+    """
+    query = {}
+    if after:
+        query["_id"] = {"$gt": after}
+    if completed is not None:
+        query["completed"] = completed
+    if status:
+        query["status"] = status
+    if due_after or due_before or overdue_at:
+        query["deadline"] = {}
+        if due_after:
+            query["deadline"]["$gte"] = due_after
+        if due_before:
+            query["deadline"]["$lte"] = due_before
+        if overdue_at:
+            query["completed"] = False
+            query["deadline"]["$lt"] = overdue_at
+    if since is not None:
+        query["updated_seq"] = {"$gt": since - SYNC_OVERLAP_SEQS}
+    return query
+
+
+@app.route("/events", methods=["GET"])
+def events():
+    """
+    Server-sent event stream of check_in_due, task_toggled and subtasks_generated events.
+
+    A comment line is sent every SSE_HEARTBEAT_SECONDS so proxies keep the
+    connection open and disconnected clients are noticed and released.
+    """
+    client_queue = event_broker.subscribe()
+    if client_queue is None:
+        return jsonify({"error": "Too many event stream clients"}), 503
+
+    def stream():
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                yield client_queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+
+    response = Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    response.call_on_close(lambda: event_broker.unsubscribe(client_queue))
     return response
 
 
 @app.route("/subtasks", methods=["GET"])
 def get_subtasks():
     """
-    Get all subtasks from all goals, flattened into a single list
+    Get one page of subtasks from all goals, flattened into a single list.
+
+    Query parameters:
+        limit: page size (default 100, max 500)
+        cursor: opaque cursor returned as `next_cursor` by the previous page
+        completed: true/false
+        status: pending, in_progress, completed or delayed
+        due_after / due_before: ISO-8601 deadline bounds (inclusive)
+        overdue: true to list only open subtasks whose deadline has passed
+        since: sync token from a previous response; only subtasks changed after
+            it are returned, plus the ids of deleted subtasks on the first page.
+            The last SYNC_OVERLAP_SEQS changes before the token are sent again,
+            so clients must treat rows as upserts by _id
+
+    Responses carry a strong ETag and honor If-None-Match with 304, except the
+    overdue view, which changes as time passes without any write. The tag is
+    computed from the ids and updated_seq of the rows on the page, read
+    before the page is sent.
+
+    Rows are served exactly as stored: every write path stores the normalized
+    shape built by new_subtask_document, and `manage.py normalize-subtasks`
+    repairs rows written by older code.
     """
     try:
-        print("\n=== Fetching Subtasks ===")
-        print("Fetching subtasks from MongoDB...")
-        
-        # Get all goals that have subtasks
-        goals = list(tasks_collection.find({"subtasks": {"$exists": True, "$ne": []}}))
-        print(f"Found {len(goals)} goals")
-        
-        # Flatten all subtasks into a single list with parent goal info
-        flattened_subtasks = []
-        for goal in goals:
-            print(f"Processing goal {goal.get('_id')}: {goal.get('goal', 'Untitled')}")
-            
-            if not isinstance(goal.get("subtasks"), list):
-                print(f"No subtasks found for goal {goal.get('_id')}")
-                continue
-                
-            for subtask in goal["subtasks"]:
-                if not isinstance(subtask, dict):
-                    print(f"Invalid subtask format in goal {goal.get('_id')}: {subtask}")
-                    continue
-                    
-                # Ensure subtask has an _id
-                if "_id" not in subtask:
-                    subtask["_id"] = str(ObjectId())
-                elif isinstance(subtask["_id"], ObjectId):
-                    subtask["_id"] = str(subtask["_id"])
-                    
-                # Add parent goal information
-                subtask["parent_goal"] = goal.get("goal", "Untitled")
-                subtask["parent_goal_id"] = str(goal["_id"])
-                
-                required_fields = {
-                    "task": "Untitled Task",
-                    "time_required": "Not specified",
-                    "deadline": (datetime.now() + timedelta(weeks=1)).isoformat(),
-                    "motivation_tips": []
-                }
-                
-                for field, default in required_fields.items():
-                    if field not in subtask:
-                        print(f"Missing {field} in subtask, using default: {default}")
-                        subtask[field] = default
-                    elif field == "motivation_tips" and not isinstance(subtask[field], list):
-                        print(f"Invalid {field} format, using default: {default}")
-                        subtask[field] = default
-                
-                # Ensure completed and completed_at fields exist
-                if "completed" not in subtask:
-                    subtask["completed"] = False
-                if "completed_at" not in subtask:
-                    subtask["completed_at"] = None
-                    
-                print(f"Adding subtask: {subtask.get('task')} (ID: {subtask['_id']})")
-                flattened_subtasks.append(subtask)
-        
-        print(f"Returning {len(flattened_subtasks)} flattened subtasks")
-        return jsonify(flattened_subtasks)
-        
+        try:
+            limit = int(request.args.get("limit", SUBTASKS_PAGE_SIZE))
+            if limit < 1:
+                raise ValueError(f"Invalid limit: {limit}")
+            limit = min(limit, SUBTASKS_MAX_PAGE_SIZE)
+            cursor = request.args.get("cursor")
+            after = decode_subtasks_cursor(cursor) if cursor else None
+            completed = parse_bool_arg(request.args.get("completed"))
+            overdue = parse_bool_arg(request.args.get("overdue"))
+            if overdue and completed:
+                raise ValueError("overdue cannot be combined with completed=true")
+            due_after = parse_due_bound(request.args.get("due_after"))
+            due_before = parse_due_bound(request.args.get("due_before"), end_of_day=True)
+            since = request.args.get("since")
+            if since is not None:
+                if not since.isdigit():
+                    raise ValueError(f"Invalid since token: {since}")
+                since = int(since)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Read before the page, so every change after the token is either on this page or in a later delta
+        seq = current_change_seq()
+
+        query = build_subtasks_query(
+            after=after,
+            completed=completed,
+            status=request.args.get("status"),
+            due_after=due_after,
+            due_before=due_before,
+            since=since,
+            overdue_at=datetime.now() if overdue else None,
+        )
+        deleted = None
+        if since is not None and not cursor:
+            tombstones = tombstones_collection.find(
+                {"kind": "subtask", "seq": {"$gt": since - SYNC_OVERLAP_SEQS}},
+                {"ref_id": 1}
+            )
+            deleted = [tombstone["ref_id"] for tombstone in tombstones]
+
+        # Pick the page by id first, fetching one extra to learn whether another page follows
+        keys = list(subtasks_collection.find(query, {"updated_seq": 1}).sort("_id", 1).limit(limit + 1))
+        page = {"count": 0, "more": len(keys) > limit}
+        keys = keys[:limit]
+
+        etag = None
+        if not overdue:
+            etag = list_etag(keys, [{"_id": ref_id} for ref_id in deleted or []], [{"_id": page["more"]}])
+            cached = not_modified(etag)
+            if cached:
+                return cached
+
+        def page_batches():
+            results = subtasks_collection.find(
+                {"_id": {"$in": [key["_id"] for key in keys]}},
+                SERVED_SUBTASK_PROJECTION
+            ).sort("_id", 1)
+            for batch in cursor_batches(results):
+                page["count"] += len(batch)
+                yield batch
+
+        def page_tail():
+            next_id = keys[-1]["_id"] if keys else None
+            tail = {"next_cursor": encode_subtasks_cursor(next_id) if page["more"] else None}
+            if deleted is not None:
+                tail["deleted"] = deleted
+            logger.info("Returned subtasks page", extra={"count": page["count"], "more": page["more"]})
+            return "]," + app.json.dumps(tail)[1:]
+
+        # {"sync_token": ..., "subtasks": [...], "next_cursor": ..., "deleted": [...]}
+        head = app.json.dumps({"sync_token": str(seq)})[:-1] + ',"subtasks":['
+        response = Response(stream_json_array(page_batches(), head, page_tail), mimetype="application/json")
+        if etag:
+            response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
     except Exception as e:
         error_msg = f"Error fetching subtasks: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
 
+# Page sizes of the history listing
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+@app.route("/subtasks/<task_id>/history", methods=["GET"])
+def get_subtask_history(task_id):
+    """
+    Return a subtask's check-ins and progress notes, newest first, a page at a time.
+
+    Query parameters:
+        limit: page size (default HISTORY_PAGE_SIZE, at most HISTORY_MAX_PAGE_SIZE)
+        cursor: opaque cursor from the previous page's `next_cursor`
+        kind: only "check_in" or only "progress_note" entries
+    """
+    try:
+        if not ObjectId.is_valid(task_id):
+            return jsonify({"error": f"Invalid task_id format: {task_id}"}), 400
+        try:
+            limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+
+        kind = request.args.get("kind")
+        if kind is not None and kind not in HISTORY_KINDS:
+            return jsonify({"error": f"kind must be one of {', '.join(HISTORY_KINDS)}"}), 400
+        cursor = request.args.get("cursor")
+        try:
+            before = decode_history_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        task = subtasks_collection.find_one({"_id": ObjectId(task_id)}, {"history_counts": 1})
+        if not task:
+            return jsonify({"error": "Task not found"}), 404
+
+        entries, next_cursor = read_history(ObjectId(task_id), limit, before, kind)
+        return jsonify({
+            "task_id": task_id,
+            "entries": entries,
+            "counts": task.get("history_counts") or {},
+            "next_cursor": next_cursor
+        })
+
+    except Exception as e:
+        error_msg = f"Error fetching history: {str(e)}"
+        logger.error(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+
+STATS_DAYS = 30  # Default period of /stats
+STATS_MAX_DAYS = 366
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """
+    Productivity and procrastination statistics, from the daily rollups.
+
+    ?from= and ?to= (YYYY-MM-DD, inclusive) select the period, by default
+    the last STATS_DAYS days; ?goal_id= restricts it to one goal. The period
+    totals come from the stats_daily buckets, one per goal and day with any
+    activity. `current` describes the subtasks as they are now: overdue
+    depends on the clock rather than on writes, so it is counted from the
+    (completed, deadline) index instead of being rolled up.
+    """
+    try:
+        now = datetime.now()
+        try:
+            end = parse_due_bound(request.args.get("to")) or now
+            start = parse_due_bound(request.args.get("from")) or end - timedelta(days=STATS_DAYS - 1)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if start > end:
+            return jsonify({"error": "from must not be after to"}), 400
+        if (end.date() - start.date()).days >= STATS_MAX_DAYS:
+            return jsonify({"error": f"The period can span at most {STATS_MAX_DAYS} days"}), 400
+
+        goal_id = request.args.get("goal_id")
+        if goal_id is not None and not ObjectId.is_valid(goal_id):
+            return jsonify({"error": f"Invalid goal_id format: {goal_id}"}), 400
+        goal_obj_id = ObjectId(goal_id) if goal_id is not None else None
+
+        stats = read_stats(stats_day(start), stats_day(end), goal_obj_id)
+
+        scope = {"parent_goal_id": goal_obj_id} if goal_obj_id is not None else {}
+        open_count = subtasks_collection.count_documents({**scope, "completed": False})
+        completed_count = subtasks_collection.count_documents({**scope, "completed": True})
+        overdue_count = subtasks_collection.count_documents({**scope, "completed": False, "deadline": {"$lt": now}})
+        total = open_count + completed_count
+
+        return jsonify({
+            "from": stats_day(start),
+            "to": stats_day(end),
+            "goal_id": goal_id,
+            **stats,
+            "current": {
+                "open": open_count,
+                "completed": completed_count,
+                "overdue": overdue_count,
+                "completion_rate": round(completed_count / total, 3) if total else None
+            }
+        })
+
+    except Exception as e:
+        logger.error("Error reading stats: %s", e)
+        return jsonify({"error": "Failed to read stats"}), 500
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Prometheus text exposition of request, MongoDB, LLM and job metrics.
+    """
+    SSE_CLIENTS.set(event_broker.client_count())
+    LLM_CIRCUIT_OPEN.set(0 if llm_gateway.breaker.state == "closed" else 1)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """
+    Report hit and miss counters for the LLM response cache.
+    """
+    return jsonify(llm_cache.snapshot())
+
+
 @app.route("/get-tasks", methods=["GET"])
 def get_tasks():
     """
     Endpoint to fetch all tasks.
+
+    The ETag is derived from the latest changes and the size of each
+    collection (see recent_changes), so an unchanged list is answered with
+    304 from a few indexed reads. Clients that poll should prefer the
+    paginated /subtasks?since= delta sync.
     """
     try:
-        # Fetch all tasks from MongoDB
-        tasks = list(tasks_collection.find())
-        
-        # Convert ObjectId to string for JSON serialization
-        for task in tasks:
-            task["_id"] = str(task["_id"])
-        
-        return jsonify(tasks), 200
+        etag = list_etag(
+            recent_changes(goals_collection),
+            recent_changes(subtasks_collection),
+            sizes=(goals_collection.estimated_document_count(), subtasks_collection.estimated_document_count())
+        )
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        def goal_batches():
+            # Attach subtasks one batch of goals at a time, so the whole list is never in memory
+            for goals in cursor_batches(goals_collection.find().sort("_id", 1)):
+                subtasks_by_goal = {}
+                subtasks = subtasks_collection.find(
+                    {"parent_goal_id": {"$in": [goal["_id"] for goal in goals]}},
+                    SERVED_SUBTASK_PROJECTION
+                ).sort("_id", 1)
+                for subtask in subtasks:
+                    subtasks_by_goal.setdefault(subtask["parent_goal_id"], []).append(subtask)
+                for goal in goals:
+                    goal["subtasks"] = subtasks_by_goal.get(goal["_id"], [])
+                yield goals
+
+        response = Response(stream_json_array(goal_batches()), mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response, 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/delete-task/<goal_id>", methods=["DELETE", "OPTIONS"])
+def delete_task(goal_id):
+    """
+    Delete a goal and its subtasks, leaving tombstones for delta sync clients.
+    """
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
+    try:
+        if not ObjectId.is_valid(goal_id):
+            return jsonify({"error": f"Invalid goal_id format: {goal_id}"}), 400
+
+        goal_obj_id = ObjectId(goal_id)
+        goal = goals_collection.find_one_and_delete({"_id": goal_obj_id}, projection={"_id": 1})
+        if not goal:
+            return jsonify({"error": f"Goal not found with ID: {goal_id}"}), 404
+
+        subtask_ids = [
+            subtask["_id"] for subtask in subtasks_collection.find({"parent_goal_id": goal_obj_id}, {"_id": 1})
+        ]
+        if subtask_ids:
+            subtasks_collection.delete_many({"_id": {"$in": subtask_ids}})
+            delete_history(subtask_ids)
+
+        seq = next_change_seq()
+        deleted_at = datetime.now()
+        tombstones = [{"kind": "goal", "ref_id": goal_id, "seq": seq, "deleted_at": deleted_at}]
+        for subtask_id in subtask_ids:
+            tombstones.append({"kind": "subtask", "ref_id": str(subtask_id), "seq": seq, "deleted_at": deleted_at})
+        insert_documents(tombstones_collection, tombstones)
+
+        return jsonify({
+            "success": True,
+            "message": "Task deleted successfully",
+            "deleted_subtasks": len(tombstones) - 1
+        })
+
+    except Exception as e:
+        error_msg = f"Error deleting task: {str(e)}"
+        logger.error(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+
+def request_goal_breakdown(task, route="add_task", fallback=True):
+    """
+    Ask DeepSeek for the subtasks of a goal, falling back to the default breakdown if it is unavailable.
+
+    `route` names the call site, which picks the LLM deadline; the reply is
+    cached under the same key whichever call site asked for it. Without
+    `fallback`, LLMUnavailableError (a timeout or an open circuit) is raised
+    instead, for callers that report it.
+    """
+    template = """Break down this goal into 3-5 specific, actionable subtasks: "{goal}"
+
+    For each subtask, provide:
+    1. A clear, specific action item
+    2. Estimated time to complete (e.g. "2 hours", "3 days")
+    3. Suggested deadline relative to now (e.g. "in 2 days", "by next week")
+    4. 2-3 motivation tips specific to this subtask
+    5. Key milestones or checkpoints
+
+    Format as JSON array with these fields:
+    {{
+        "task": "specific action",
+        "estimated_hours": number,
+        "deadline": "relative deadline",
+        "motivation_tips": ["tip1", "tip2"],
+        "checkpoints": ["milestone1", "milestone2"]
+    }}"""
+    
+    try:
+        subtasks_str = cached_completion(
+            route,
+            task,
+            ADD_TASK_PROMPT_VERSION,
+            prompt_builder.messages(
+                route,
+                template,
+                [Field("goal", task, PROMPT_GOAL_TOKENS)],
+                system="You are a helpful task breakdown and productivity assistant."
+            )
+        )
+    except LLMUnavailableError as e:
+        if not fallback:
+            raise
+        logger.warning("DeepSeek API unavailable, using the default breakdown: %s", e)
+        subtasks = default_subtasks(task)
+    else:
+        # Parse the response
+        logger.debug("Breakdown response: %s", subtasks_str)
+        subtasks = parse_breakdown_to_subtasks(subtasks_str, task)
+    if not isinstance(subtasks, list):
+        raise ValueError("Expected a list of subtasks")
+    return subtasks
+
+
+def goal_breakdown_documents(subtasks, goal_id, task, seq, created_at):
+    """
+    Build the stored subtasks of a goal from request_goal_breakdown's result.
+
+    Each document records its position in the breakdown as breakdown_index,
+    which is unique per goal, so storing the same breakdown twice cannot
+    duplicate subtasks.
+    """
+    documents = []
+    for index, subtask in enumerate(subtasks):
+        # Convert estimated hours to duration string
+        hours = subtask.get("estimated_hours", 1)
+        if hours < 1:
+            time_required = f"{int(hours * 60)} minutes"
+        elif hours == 1:
+            time_required = "1 hour"
+        else:
+            time_required = f"{hours} hours"
+        
+        # parse_breakdown_to_subtasks already resolved the relative deadline to a date
+        subtask = dict(subtask, time_required=time_required, estimated_hours=hours)
+        document = new_subtask_document(subtask, ObjectId(goal_id), task, seq, created_at)
+        document["breakdown_index"] = index
+        documents.append(document)
+    return documents
+
+
+def stored_breakdown(goal_id):
+    """The subtasks breakdown_goal stored for a goal, in breakdown order."""
+    subtasks = subtasks_collection.find(
+        {"parent_goal_id": ObjectId(goal_id), "breakdown_index": {"$exists": True}},
+        SERVED_SUBTASK_PROJECTION
+    ).sort("breakdown_index", 1)
+    return [serialize_subtask(subtask) for subtask in subtasks]
+
+
+def breakdown_goal(goal_id, task):
+    """
+    Generate subtasks for a stored goal with DeepSeek, store them in the subtasks collection and return them.
+
+    Safe to run again for the same goal, as a retried job does: a goal that
+    was already broken down returns its stored subtasks without calling the
+    LLM, and a run that stopped partway only adds the subtasks it had not
+    stored yet, since breakdown_index is unique per goal.
+    """
+    goal = goals_collection.find_one({"_id": ObjectId(goal_id)}, {"broken_down_at": 1})
+    if goal and goal.get("broken_down_at"):
+        logger.info("Goal already broken down", extra={"goal_id": goal_id})
+        return stored_breakdown(goal_id)
+
+    subtasks = request_goal_breakdown(task)
+    seq = next_change_seq()
+    created_at = datetime.now()
+    documents = goal_breakdown_documents(subtasks, goal_id, task, seq, created_at)
+
+    # Store all subtasks with one round trip; duplicates were stored by an earlier run
+    inserted, failures = insert_documents(subtasks_collection, documents)
+    failures = [failure for failure in failures if "E11000" not in failure["error"]]
+    if failures:
+        logger.warning("Failed to store %d subtasks: %s", len(failures), failures)
+    processed_subtasks = stored_breakdown(goal_id) if len(inserted) < len(documents) else [
+        serialize_subtask(subtask) for subtask in inserted
+    ]
+    
+    logger.info("Generated subtasks", extra={"goal_id": goal_id, "count": len(processed_subtasks)})
+    
+    goals_collection.update_one(
+        {"_id": ObjectId(goal_id)},
+        {"$set": {"updated_seq": seq, "broken_down_at": created_at}}
+    )
+
+    check_in_waker.schedule(created_at)
+    event_broker.publish("subtasks_generated", {
+        "goal_id": goal_id,
+        "goal": task,
+        "subtask_ids": [subtask["_id"] for subtask in processed_subtasks],
+        "sync_token": str(seq)
+    })
+    return processed_subtasks
+
+
+def wants_async_response():
+    """True if the client asked for a 202 Accepted instead of waiting for the result."""
+    if parse_bool_arg(request.args.get("async")):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
 @app.route("/add-task", methods=["POST"])
+@coalesce_submissions
 def add_task():
     """
     Add a new task and generate subtasks with OpenAI
+
+    With ?async=true or a `Prefer: respond-async` header the breakdown is
+    queued instead and the response is 202 Accepted with a job id to poll at
+    /jobs/<job_id>. Accepts an Idempotency-Key header, so a retried
+    submission returns the original goal instead of creating another one;
+    see coalesce_submissions.
     """
     try:
         data = request.json
@@ -615,145 +2466,436 @@ def add_task():
         if not task:
             return jsonify({"error": "Task is required"}), 400
 
-        print(f"\n=== Adding New Task ===")
-        print(f"Task: {task}")
+        try:
+            run_async = wants_async_response()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
             
-        # Create a new task document
+        # Create a new goal document; its subtasks live in the subtasks collection
         task_doc = {
             "goal": task,
-            "created_at": datetime.now().isoformat(),
-            "subtasks": [],
-            "status": "active"  # active, completed, delayed
+            "created_at": datetime.now(),
+            "status": "active",  # active, completed, delayed
+            "updated_seq": next_change_seq()
         }
         
-        # Insert the task into MongoDB
-        result = tasks_collection.insert_one(task_doc)
+        # Insert the goal into MongoDB
+        result = goals_collection.insert_one(task_doc)
         goal_id = str(result.inserted_id)
-        print(f"Created task with ID: {goal_id}")
+        logger.info("Created goal", extra={"goal_id": goal_id, "async": run_async})
+
+        if run_async:
+            job_id = job_queue.enqueue("breakdown", {"goal_id": goal_id, "task": task})
+            response = jsonify({
+                "success": True,
+                "message": "Task added, subtasks are being generated",
+                "goal_id": goal_id,
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}"
+            })
+            response.headers["Location"] = f"/jobs/{job_id}"
+            return response, 202
         
         # Get task breakdown from OpenAI
         try:
-            print("Getting task breakdown from OpenAI...")
-            prompt = f"""Break down this goal into 3-5 specific, actionable subtasks: "{task}"
-
-            For each subtask, provide:
-            1. A clear, specific action item
-            2. Estimated time to complete (e.g. "2 hours", "3 days")
-            3. Suggested deadline relative to now (e.g. "in 2 days", "by next week")
-            4. 2-3 motivation tips specific to this subtask
-            5. Key milestones or checkpoints
-
-            Format as JSON array with these fields:
-            {{
-                "task": "specific action",
-                "estimated_hours": number,
-                "deadline": "relative deadline",
-                "motivation_tips": ["tip1", "tip2"],
-                "checkpoints": ["milestone1", "milestone2"]
-            }}"""
-            
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": "You are a helpful task breakdown and productivity assistant."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            
-            # Parse the response
-            subtasks_str = response.choices[0].message.content
-            print("OpenAI Response:", subtasks_str)
-            
-            try:
-                subtasks = parse_breakdown_to_subtasks(subtasks_str, task)
-                if not isinstance(subtasks, list):
-                    raise ValueError("Expected a list of subtasks")
-                    
-                # Process each subtask
-                processed_subtasks = []
-                for subtask in subtasks:
-                    # Generate unique ID
-                    subtask_id = str(ObjectId())
-                    
-                    # Convert estimated hours to duration string
-                    hours = subtask.get("estimated_hours", 1)
-                    if hours < 1:
-                        time_required = f"{int(hours * 60)} minutes"
-                    elif hours == 1:
-                        time_required = "1 hour"
-                    else:
-                        time_required = f"{hours} hours"
-                    
-                    # Parse relative deadline
-                    deadline_str = subtask.get("deadline", "in 1 week")
-                    try:
-                        deadline = datetime.now()
-                        if "day" in deadline_str.lower():
-                            days = int(''.join(filter(str.isdigit, deadline_str)))
-                            deadline += timedelta(days=days)
-                        elif "week" in deadline_str.lower():
-                            weeks = int(''.join(filter(str.isdigit, deadline_str)))
-                            deadline += timedelta(weeks=weeks)
-                        else:
-                            deadline += timedelta(weeks=1)
-                    except:
-                        deadline = datetime.now() + timedelta(weeks=1)
-                    
-                    processed_subtask = {
-                        "_id": subtask_id,
-                        "task": subtask.get("task", "Untitled Task"),
-                        "time_required": time_required,
-                        "estimated_hours": hours,
-                        "deadline": deadline.isoformat(),
-                        "motivation_tips": subtask.get("motivation_tips", []),
-                        "checkpoints": subtask.get("checkpoints", []),
-                        "completed": False,
-                        "completed_at": None,
-                        "status": "pending",  # pending, in_progress, completed, delayed
-                        "check_ins": [],
-                        "parent_goal_id": goal_id
-                    }
-                    processed_subtasks.append(processed_subtask)
-                
-                print(f"Generated {len(processed_subtasks)} subtasks")
-                
-                # Update the task with subtasks
-                update_result = tasks_collection.update_one(
-                    {"_id": ObjectId(goal_id)},
-                    {"$set": {"subtasks": processed_subtasks}}
-                )
-                
-                if update_result.modified_count == 0:
-                    print("Warning: Failed to update task with subtasks")
-                    
-                return jsonify({
-                    "success": True,
-                    "message": "Task added successfully",
-                    "goal_id": goal_id,
-                    "subtasks": processed_subtasks
-                }), 201
+            processed_subtasks = breakdown_goal(goal_id, task)
+            return jsonify({
+                "success": True,
+                "message": "Task added successfully",
+                "goal_id": goal_id,
+                "subtasks": processed_subtasks
+            }), 201
                 
-            except json.JSONDecodeError as e:
-                print(f"Error parsing OpenAI response: {e}")
-                print("Response was:", subtasks_str)
-                return jsonify({"error": "Failed to parse task breakdown"}), 500
+        except json.JSONDecodeError as e:
+            logger.error("Error parsing OpenAI response: %s", e)
+            return jsonify({"error": "Failed to parse task breakdown"}), 500
                 
         except Exception as e:
-            print(f"Error getting task breakdown: {e}")
+            logger.error("Error getting task breakdown: %s", e)
             return jsonify({"error": "Failed to generate subtasks"}), 500
             
     except Exception as e:
         error_msg = f"Error adding task: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
 
+# Batch goal import
+ADD_TASKS_MAX_GOALS = 100
+ADD_TASKS_CONCURRENCY = int(os.getenv("ADD_TASKS_CONCURRENCY", "4"))  # Default parallel breakdowns per batch
+
+
+def import_goals(goal_ids, tasks, concurrency):
+    """
+    Break down a batch of goals in parallel and store the ones that succeeded.
+
+    `goal_ids` are chosen by the caller, one per task, so importing the same
+    batch again, as a retried job does, stores every goal at most once: goals
+    already broken down return their stored subtasks without calling the
+    LLM, and the subtasks of a run that stopped partway are not duplicated,
+    since breakdown_index is unique per goal. Returns (results, seq): a
+    result per goal, in request order, and the change sequence of the writes.
+    """
+    started = time.monotonic()
+    object_ids = [ObjectId(goal_id) for goal_id in goal_ids]
+    done = {goal["_id"] for goal in goals_collection.find(
+        {"_id": {"$in": object_ids}, "broken_down_at": {"$exists": True}}, {"_id": 1}
+    )}
+    results = [{"index": index, "task": task} for index, task in enumerate(tasks)]
+    pending = []
+    for result, goal_id, object_id in zip(results, goal_ids, object_ids):
+        if object_id in done:
+            result.update(goal_id=goal_id, subtasks=stored_breakdown(goal_id))
+        else:
+            pending.append(result)
+
+    # Fan the breakdowns out; copy the caller's logging context into each worker thread
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(pending)), thread_name_prefix="add-tasks") as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, request_goal_breakdown, result["task"], "add_tasks", False)
+                for result in pending
+            ]
+    else:
+        futures = []
+    generated = []
+    for result, future in zip(pending, futures):
+        index = result["index"]
+        try:
+            generated.append((result, future.result()))
+        except LLMTimeoutError as e:
+            logger.warning("Breakdown timed out: %s", e, extra={"index": index})
+            result["error"] = "Breakdown timed out"
+        except CircuitOpenError:
+            result["error"] = "LLM temporarily unavailable"
+        except LLMUnavailableError as e:
+            logger.warning("DeepSeek API unavailable: %s", e, extra={"index": index})
+            result["error"] = "LLM unavailable"
+        except Exception as e:
+            logger.error("Error getting task breakdown: %s", e, extra={"index": index})
+            result["error"] = "Failed to generate subtasks"
+
+    # Store every goal, then every subtask, in one bulk insert each; duplicates were stored by an earlier run
+    seq = next_change_seq()
+    created_at = datetime.now()
+    goal_docs = [{
+        "_id": object_ids[result["index"]],
+        "goal": result["task"],
+        "created_at": created_at,
+        "status": "active",  # active, completed, delayed
+        "updated_seq": seq
+    } for result, _ in generated]
+    _, failures = insert_documents(goals_collection, goal_docs)
+    for failure in failures:
+        if "E11000" in failure["error"]:
+            continue
+        result, _ = generated[failure["index"]]
+        logger.error("Error storing goal: %s", failure["error"], extra={"index": result["index"]})
+        result["error"] = "Failed to store goal"
+    generated = [(result, subtasks) for result, subtasks in generated if "error" not in result]
+    stored_ids = [object_ids[result["index"]] for result, _ in generated]
+
+    task_docs = []
+    for result, subtasks in generated:
+        task_docs.extend(goal_breakdown_documents(
+            subtasks, goal_ids[result["index"]], result["task"], seq, created_at
+        ))
+    stored_subtasks, failures = insert_documents(subtasks_collection, task_docs)
+    failures = [failure for failure in failures if "E11000" not in failure["error"]]
+    if failures:
+        logger.warning("Failed to store %d subtasks: %s", len(failures), failures)
+    if len(stored_subtasks) < len(task_docs):
+        stored_subtasks = subtasks_collection.find(
+            {"parent_goal_id": {"$in": stored_ids}, "breakdown_index": {"$exists": True}},
+            SERVED_SUBTASK_PROJECTION
+        ).sort("breakdown_index", 1)
+    if stored_ids:
+        # Marked last, so a run that stops before this point breaks the goals down again
+        goals_collection.update_many({"_id": {"$in": stored_ids}}, {"$set": {"broken_down_at": created_at}})
+
+    subtasks_by_goal = {}
+    for task_doc in stored_subtasks:
+        subtasks_by_goal.setdefault(str(task_doc["parent_goal_id"]), []).append(serialize_subtask(task_doc))
+    for result, _ in generated:
+        goal_id = goal_ids[result["index"]]
+        result.update(goal_id=goal_id, subtasks=subtasks_by_goal.get(goal_id, []))
+        event_broker.publish("subtasks_generated", {
+            "goal_id": goal_id,
+            "goal": result["task"],
+            "subtask_ids": [subtask["_id"] for subtask in result["subtasks"]],
+            "sync_token": str(seq)
+        })
+    if subtasks_by_goal:
+        check_in_waker.schedule(created_at)
+
+    logger.info("Imported goals", extra={
+        "requested": len(tasks), "stored": len(generated), "already_stored": len(done),
+        "failed": sum("error" in result for result in results),
+        "concurrency": concurrency, "seconds": round(time.monotonic() - started, 3)
+    })
+    return results, seq
+
+
+def import_summary(results, seq):
+    """The /add-tasks response body, and /add-tasks job result, for import_goals' results."""
+    added = sum("error" not in result for result in results)
+    return {
+        "success": added == len(results),
+        "message": f"Added {added} of {len(results)} tasks",
+        "requested": len(results),
+        "added": added,
+        "failed": len(results) - added,
+        "sync_token": str(seq),
+        "results": results
+    }
+
+
+@app.route("/add-tasks", methods=["POST"])
+@coalesce_submissions
+def add_tasks():
+    """
+    Add many goals at once and generate their subtasks in parallel.
+
+    Expects {"tasks": ["goal", ...]}. Up to ?concurrency= breakdowns run at
+    a time (default ADD_TASKS_CONCURRENCY, at most LLM_MAX_CONCURRENCY), each
+    within the add_tasks LLM deadline, so a batch takes about
+    len(tasks) / concurrency breakdowns rather than len(tasks). All goals and
+    subtasks are then stored with one bulk insert each, under one change
+    sequence. The response lists a result per goal, in request order. A goal
+    whose breakdown failed, including an LLM timeout or an open circuit, is
+    reported with its error and is not stored, so it can be resubmitted; the
+    others are. There is no fallback to the default breakdown.
+
+    With ?async=true or a `Prefer: respond-async` header the batch is queued
+    instead of holding the request: the response is 202 Accepted with the
+    ids the goals will be stored under and a job id to poll at
+    /jobs/<job_id>, whose result is the body a synchronous import would have
+    returned. Accepts an Idempotency-Key header, whose claim is renewed
+    while a long batch runs; see coalesce_submissions.
+    """
+    try:
+        data = request.get_json(silent=True)
+        tasks = data.get("tasks") if isinstance(data, dict) else None
+        if not isinstance(tasks, list) or not tasks:
+            return jsonify({"error": "tasks must be a non-empty list"}), 400
+        if len(tasks) > ADD_TASKS_MAX_GOALS:
+            return jsonify({"error": f"At most {ADD_TASKS_MAX_GOALS} tasks per request"}), 400
+        if not all(isinstance(task, str) and task.strip() for task in tasks):
+            return jsonify({"error": "Every task must be a non-empty string"}), 400
+        try:
+            concurrency = int(request.args.get("concurrency", ADD_TASKS_CONCURRENCY))
+        except ValueError:
+            return jsonify({"error": "concurrency must be an integer"}), 400
+        concurrency = max(1, min(concurrency, LLM_MAX_CONCURRENCY, len(tasks)))
+        try:
+            run_async = wants_async_response()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        goal_ids = [str(ObjectId()) for _ in tasks]
+        if run_async:
+            job_id = job_queue.enqueue("add_tasks", {"goal_ids": goal_ids, "tasks": tasks, "concurrency": concurrency})
+            logger.info("Queued goal import", extra={"job_id": job_id, "requested": len(tasks)})
+            response = jsonify({
+                "success": True,
+                "message": f"{len(tasks)} tasks accepted, subtasks are being generated",
+                "requested": len(tasks),
+                "goal_ids": goal_ids,
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}"
+            })
+            response.headers["Location"] = f"/jobs/{job_id}"
+            return response, 202
+
+        results, seq = import_goals(goal_ids, tasks, concurrency)
+        summary = import_summary(results, seq)
+        if not summary["added"]:
+            return jsonify({"error": "Failed to add any tasks", "results": results}), 500
+        return jsonify(summary), 201
+
+    except Exception as e:
+        error_msg = f"Error adding tasks: {str(e)}"
+        logger.error(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    Report the status of a queued job and, once it is done, its result.
+    """
+    try:
+        if not ObjectId.is_valid(job_id):
+            return jsonify({"error": f"Invalid job_id format: {job_id}"}), 400
+
+        job = jobs_collection.find_one({"_id": ObjectId(job_id)})
+        if not job:
+            return jsonify({"error": f"Job not found with ID: {job_id}"}), 404
+
+        return jsonify({
+            "job_id": job_id,
+            "type": job["type"],
+            "status": job["status"],  # queued, running, done, failed
+            "attempts": job.get("attempts", 0),
+            "payload": job.get("payload"),
+            "result": job.get("result"),
+            "error": job.get("error"),
+            "created_at": job["created_at"].isoformat(),
+            "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None
+        })
+
+    except Exception as e:
+        error_msg = f"Error fetching job: {str(e)}"
+        logger.error(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+
+# Background job settings
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE = timedelta(minutes=5)  # A running job not finished by then is picked up again
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_SECONDS = 5
+
+
+class JobQueue:
+    """
+    Durable job queue backed by the jobs collection and drained by a fixed pool of worker threads.
+
+    Jobs are claimed atomically with find_one_and_update, so queued jobs, and
+    running jobs whose lease has expired after a crash or restart, are
+    picked up by the next free worker. The lease of a job is renewed while it
+    runs, so a long job is not picked up a second time.
+    """
+
+    def __init__(self, collection, handlers, workers=JOB_WORKERS):
+        self.collection = collection
+        self.handlers = handlers
+        self.workers = workers
+        self.condition = threading.Condition()
+
+    def enqueue(self, job_type, payload):
+        """Store a new job and wake a worker. Returns the job id as a string."""
+        now = datetime.now()
+        result = self.collection.insert_one({
+            "type": job_type,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now
+        })
+        with self.condition:
+            self.condition.notify()
+        return str(result.inserted_id)
+
+    def claim(self):
+        """Atomically take the oldest runnable job, or return None if there is none."""
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "started_at": now,
+                    "updated_at": now,
+                    "lease_expires_at": now + JOB_LEASE
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def renew(self, job, finished):
+        """Extend the lease of a running job every third of JOB_LEASE until `finished` is set."""
+        while not finished.wait(JOB_LEASE.total_seconds() / 3):
+            try:
+                self.collection.update_one(
+                    {"_id": job["_id"], "status": "running", "attempts": job["attempts"]},
+                    {"$set": {"lease_expires_at": datetime.now() + JOB_LEASE}}
+                )
+            except Exception as e:
+                logger.error("Error renewing job %s: %s", job["_id"], e)
+
+    def process(self, job):
+        """Run one claimed job and record its outcome."""
+        finished = threading.Event()
+        threading.Thread(target=self.renew, args=(job, finished), daemon=True).start()
+        try:
+            with log_context(f"job-{job['_id']}", job["type"]), JOB_DURATION.time(job=job["type"]):
+                try:
+                    result = self.handlers[job["type"]](job["payload"])
+                finally:
+                    finished.set()
+            now = datetime.now()
+            self.collection.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"status": "done", "result": result, "finished_at": now, "updated_at": now},
+                 "$unset": {"lease_expires_at": ""}}
+            )
+        except Exception as e:
+            logger.error("Error running job %s: %s", job["_id"], e)
+            now = datetime.now()
+            failed = job["attempts"] >= JOB_MAX_ATTEMPTS
+            update = {"status": "failed" if failed else "queued", "error": str(e), "updated_at": now}
+            if failed:
+                update["finished_at"] = now
+            self.collection.update_one(
+                {"_id": job["_id"]},
+                {"$set": update, "$unset": {"lease_expires_at": ""}}
+            )
+
+    def work(self):
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                logger.error("Error claiming job: %s", e)
+                job = None
+            if job is None:
+                with self.condition:
+                    self.condition.wait(JOB_POLL_SECONDS)
+                continue
+            self.process(job)
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+
+def run_breakdown_job(payload):
+    """Job handler: generate and store the subtasks for a goal created by /add-task."""
+    return {"subtasks": breakdown_goal(payload["goal_id"], payload["task"])}
+
+
+def run_add_tasks_job(payload):
+    """Job handler: import a batch of goals queued by /add-tasks."""
+    results, seq = import_goals(payload["goal_ids"], payload["tasks"], payload["concurrency"])
+    return import_summary(results, seq)
+
+
+job_queue = JobQueue(jobs_collection, {"breakdown": run_breakdown_job, "add_tasks": run_add_tasks_job})
+
+
 def generate_motivation(task_info, status, reason=None):
     """Generate a motivational response based on task status and reason."""
+    # A plain progress update can be answered with the message prepared by the scheduler
+    precomputed = fresh_precomputed_motivation(task_info)
+    if precomputed and not reason and status in ("pending", "in_progress"):
+        return {
+            "response": precomputed["message"],
+            "suggestions": precomputed.get("suggestions") or [],
+            "motivation": precomputed.get("motivation") or "Every small step counts. You've got this!"
+        }
+
     try:
-        prompt = f"""Task: {task_info.get('task', 'your task')}
+        template = """Task: {task}
 Status: {status}
-Reason: {reason if reason else 'No reason provided'}
+Reason: {reason}
+Earlier check-ins: {history}
 
 Please provide:
 1. A supportive and understanding response
@@ -767,17 +2909,23 @@ Format the response as a JSON object with these fields:
     "motivation": "A brief motivational message"
 }}"""
 
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "You are an empathetic productivity coach."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
+        response_text = llm_gateway.complete(
+            "generate_motivation",
+            prompt_builder.messages(
+                "generate_motivation",
+                template,
+                [
+                    Field("task", task_info.get("task") or "your task", PROMPT_TASK_TOKENS),
+                    Field("status", status),
+                    Field("reason", reason, PROMPT_REASON_TOKENS, empty="No reason provided"),
+                    history_field(task_info)
+                ],
+                system="You are an empathetic productivity coach."
+            )
         )
 
         # Clean the response
-        response_text = response.choices[0].message.content.strip()
+        response_text = response_text.strip()
         if response_text.startswith('```json'):
             response_text = response_text[7:]
         if response_text.endswith('```'):
@@ -799,7 +2947,7 @@ Format the response as a JSON object with these fields:
         return motivation_data
 
     except Exception as e:
-        print(f"Error generating motivation: {str(e)}")
+        logger.error("Error generating motivation: %s", e)
         # Return a default response if generation fails
         return {
             "response": "I understand you're facing some challenges. Remember that setbacks are temporary and part of the journey.",
@@ -820,7 +2968,7 @@ def check_in(goal_id, task_id):
         reason = data.get("reason", "")
 
         # Find the task in MongoDB
-        task = db.tasks.find_one({"_id": ObjectId(task_id)})
+        task = subtasks_collection.find_one({"_id": ObjectId(task_id)})
         if not task:
             return jsonify({"error": "Task not found"}), 404
 
@@ -828,30 +2976,57 @@ def check_in(goal_id, task_id):
         motivation = generate_motivation(task, status, reason)
 
         # Create check-in record
-        check_in = {
-            "timestamp": datetime.now().isoformat(),
+        checked_in_at = datetime.now()
+        check_in = new_history_entry({
+            "timestamp": checked_in_at.isoformat(),
             "status": status,
             "reason": reason,
             "response": motivation.get("response"),
             "suggestions": motivation.get("suggestions", []),
             "motivation": motivation.get("motivation")
-        }
+        }, checked_in_at)
 
         # Update task in MongoDB
-        update_result = db.tasks.update_one(
+        seq = next_change_seq()
+        next_check_at = None
+        if status != "completed":
+            next_check_at = compute_next_check_at(parse_deadline(task.get("deadline")), checked_in_at)
+        update_result = subtasks_collection.update_one(
             {"_id": ObjectId(task_id)},
             {
                 "$set": {
                     "status": status,
                     "completed": status == "completed",
-                    "completed_at": datetime.now().isoformat() if status == "completed" else None
+                    "completed_at": checked_in_at if status == "completed" else None,
+                    "last_check_in": checked_in_at,
+                    "next_check_at": next_check_at,
+                    "updated_seq": seq
                 },
-                "$push": {"check_ins": check_in}
+                "$unset": {"precomputed_motivation": ""},
+                **recent_history_update("check_in", check_in)
             }
         )
 
         if update_result.modified_count == 0:
             return jsonify({"error": "Failed to update task"}), 500
+        append_history(ObjectId(task_id), "check_in", check_in)
+        record_stats(stats_operation(
+            task["parent_goal_id"],
+            checked_in_at,
+            {"check_ins": 1, **completion_counts(task.get("completed", False), status == "completed")},
+            status=status,
+            # Reasons given for finishing say nothing about procrastination
+            reason=reason if status != "completed" else None
+        ))
+
+        check_in_waker.schedule(next_check_at)
+        if task.get("completed", False) != (status == "completed"):
+            event_broker.publish("task_toggled", {
+                "goal_id": goal_id,
+                "task_id": task_id,
+                "completed": status == "completed",
+                "sync_token": str(seq)
+            })
 
         return jsonify({
             "success": True,
@@ -859,9 +3034,58 @@ def check_in(goal_id, task_id):
         })
 
     except Exception as e:
-        print(f"Error in check-in: {str(e)}")
+        logger.error("Error in check-in: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
+def start_background_services(multiprocess=False):
+    """
+    Start the threads behind the API, once per process.
+
+    Every process runs job workers and competes for the scheduler lease; the
+    holder runs the scheduled jobs and the check-in waker. With
+    `multiprocess`, server-sent events are relayed between processes and the
+    waker polls for due tasks every MULTIPROCESS_CHECK_IN_INTERVAL.
+    """
+    global scheduler_started
+    with scheduler_lock:
+        if scheduler_started:
+            return
+        scheduler_started = True
+
+    # Create indexes on startup
+    ensure_indexes()
+
+    if multiprocess:
+        event_broker.relay = EventRelay(event_broker, events_collection)
+        event_broker.relay.ensure_collection()
+        threading.Thread(target=event_broker.relay.run, daemon=True).start()
+        check_in_waker.safety_interval = MULTIPROCESS_CHECK_IN_INTERVAL
+
+    # Hand the lease over straight away on a clean shutdown
+    atexit.register(scheduler_lease.release)
+    threading.Thread(target=scheduler_lease.run, daemon=True).start()
+    threading.Thread(target=run_scheduler, daemon=True).start()
+    threading.Thread(target=check_in_waker.run, daemon=True).start()
+    job_queue.start()
+
+
+def create_app(multiprocess=False, start_background=True, worker_threads=None):
+    """
+    Return the Flask app, with its background services started unless `start_background` is false.
+
+    wsgi.py calls this with multiprocess=True for servers running several
+    worker processes; see start_background_services. `worker_threads` is the
+    number of request threads per process. Every open /events stream holds
+    one of them, so at most SSE_THREAD_SHARE of them may be streams, and the
+    rest stay free for other requests.
+    """
+    if worker_threads is not None:
+        event_broker.max_clients = max(1, min(SSE_MAX_CLIENTS, int(worker_threads * SSE_THREAD_SHARE)))
+    if start_background:
+        start_background_services(multiprocess)
+    return app
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
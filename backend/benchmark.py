@@ -0,0 +1,304 @@
+"""
+Micro-benchmarks for the backend's hot functions and endpoints.
+
+Runs offline: MongoDB is replaced by mongomock unless --mongo-uri points at a
+local mongod, and the DeepSeek client is replaced by a stub that returns a
+canned breakdown. Each dataset size is seeded with synthetic goals before
+its cases run.
+
+Usage:
+    python benchmark.py [--sizes 100,1000] [--repeat 5] [--mongo-uri URI]
+                        [--save baseline.json] [--compare baseline.json] [--tolerance 0.25]
+
+Every case reports median and p95 latency over --repeat runs, plus peak
+memory allocated during one extra run traced with tracemalloc. --save writes
+the results as a JSON baseline; --compare exits non-zero if any case got
+slower than a baseline by more than --tolerance.
+
+mongomock scans collections without using indexes, so datasets of 10k
+goals and more are best measured against a local mongod, e.g.
+--mongo-uri mongodb://localhost:27017 --sizes 100,1000,10000,100000. Only
+the pk-agent-benchmark database is touched, and it is dropped afterwards.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+BENCHMARK_DB = "pk-agent-benchmark"
+SUBTASKS_PER_GOAL = 4
+SEED_BATCH_SIZE = 5000
+
+CANNED_BREAKDOWN = json.dumps([
+    {
+        "task": f"Step {index} of the goal",
+        "estimated_hours": index + 1,
+        "deadline": f"in {index + 1} days",
+        "motivation_tips": ["Start small", "Track progress"],
+        "checkpoints": ["Begin", "Finish"]
+    }
+    for index in range(5)
+])
+
+
+class StubCompletions:
+    """Stands in for client.chat.completions and answers every prompt with CANNED_BREAKDOWN."""
+
+    def create(self, stream=False, **kwargs):
+        message = SimpleNamespace(content=CANNED_BREAKDOWN)
+        usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def load_app(mongo_uri):
+    """Import the app against the benchmark database, with the LLM client stubbed out."""
+    os.environ["MONGO_DB"] = BENCHMARK_DB
+    os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+    # Log records are written to stderr by the logging thread, which redirect_stdout cannot hide
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if mongo_uri:
+        os.environ["MONGO_URI"] = mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required without --mongo-uri: pip install mongomock")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    app.llm_gateway.client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions()))
+    # Writes wake the check-in thread; keep it from running check_tasks_job during measurements
+    app.check_in_waker.schedule = lambda when: None
+    return app
+
+
+def reset_database(app):
+    """Drop every collection of the benchmark database and recreate the indexes."""
+    for name in app.goals_collection.database.list_collection_names():
+        app.goals_collection.database.drop_collection(name)
+    app.ensure_indexes()
+
+
+def seed(app, goal_count):
+    """
+    Insert `goal_count` synthetic goals with SUBTASKS_PER_GOAL subtasks each.
+
+    Deadlines are spread from two weeks ago to four weeks ahead and roughly a
+    third of the subtasks are completed, so filters and the urgency rule see
+    a realistic mix.
+    """
+    reset_database(app)
+    now = datetime.now()
+    seq = app.next_change_seq()
+    for start in range(0, goal_count, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, goal_count - start)
+        goals = [
+            {"goal": f"Goal {start + index}", "created_at": now, "status": "active", "updated_seq": seq}
+            for index in range(count)
+        ]
+        app.goals_collection.insert_many(goals)
+
+        subtasks = []
+        for goal in goals:
+            for index in range(SUBTASKS_PER_GOAL):
+                number = len(subtasks) + start * SUBTASKS_PER_GOAL
+                subtask = {
+                    "task": f"{goal['goal']} step {index}",
+                    "time_required": "2 hours",
+                    "deadline": now + timedelta(hours=(number * 7) % (42 * 24) - 14 * 24),
+                    "motivation_tips": ["Keep going"]
+                }
+                document = app.new_subtask_document(subtask, goal["_id"], goal["goal"], seq, now)
+                if number % 3 == 0:
+                    document.update(completed=True, completed_at=now, status="completed", next_check_at=None)
+                subtasks.append(document)
+        app.subtasks_collection.insert_many(subtasks)
+
+
+def measure(function, repeat, setup=None):
+    """Time `repeat` calls of `function`, then trace one more for memory. Returns the summary dict."""
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if setup:
+            setup()
+        function()  # Warm up caches and lazily created indexes
+        for _ in range(repeat):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "median_ms": round(statistics.median(timings), 4),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def function_cases(app):
+    """Benchmarks of pure functions, independent of the dataset size."""
+    now = datetime.now()
+    deadlines = [now + timedelta(hours=hours) for hours in range(-48, 24 * 14, 7)]
+    last_check_in = now - timedelta(hours=3)
+    subtask = {"task": "Write the outline", "time_required": "1 hour", "deadline": now + timedelta(days=2)}
+
+    def urgency_rule():
+        for deadline in deadlines:
+            app.should_check_in(deadline, last_check_in, now)
+            app.compute_next_check_at(deadline, last_check_in, now)
+
+    return {
+        "parse_relative_deadline": lambda: app.parse_relative_deadline("in 3 days"),
+        "parse_deadline": lambda: app.parse_deadline("2025-03-01T12:30:00"),
+        "parse_breakdown_to_subtasks": lambda: app.parse_breakdown_to_subtasks(CANNED_BREAKDOWN, "Benchmark goal"),
+        f"urgency_rule_x{len(deadlines)}": urgency_rule,
+        "new_subtask_document": lambda: app.new_subtask_document(subtask, None, "Benchmark goal", 1, now),
+        "build_subtasks_query": lambda: app.build_subtasks_query(completed=False, due_before=now, since=10),
+    }
+
+
+def endpoint_cases(app):
+    """Benchmarks that hit the seeded database, through the Flask test client where there is a route."""
+    client = app.app.test_client()
+    counter = {"goal": 0}
+
+    def get(url):
+        response = client.get(url)
+        response.get_data()  # Drain streamed bodies
+        assert response.status_code == 200, f"{url}: {response.status_code}"
+
+    def walk_subtasks():
+        url = "/subtasks?limit=500"
+        while url:
+            response = client.get(url)
+            next_cursor = response.get_json()["next_cursor"]
+            url = f"/subtasks?limit=500&cursor={next_cursor}" if next_cursor else None
+
+    subtask = app.subtasks_collection.find_one({"completed": False}, {"parent_goal_id": 1})
+
+    def toggle_task():
+        response = client.post(f"/toggle-task/{subtask['parent_goal_id']}/{subtask['_id']}")
+        assert response.status_code == 200, f"toggle-task: {response.status_code}"
+
+    def add_task():
+        # A new goal text each time, so the LLM cache misses and the stub is called
+        counter["goal"] += 1
+        response = client.post("/add-task", json={"task": f"Benchmark goal {counter['goal']}"})
+        assert response.status_code == 201, f"add-task: {response.status_code}"
+
+    def make_checks_due():
+        app.subtasks_collection.update_many({"completed": False}, {"$set": {"next_check_at": datetime.now()}})
+
+    return {
+        "GET /subtasks (first page)": (lambda: get("/subtasks"), None),
+        "GET /subtasks (all pages)": (walk_subtasks, None),
+        "GET /subtasks?overdue=true": (lambda: get("/subtasks?overdue=true&limit=500"), None),
+        "GET /subtasks?since": (lambda: get(f"/subtasks?since={app.current_change_seq() - 1}"), None),
+        "GET /get-tasks": (lambda: get("/get-tasks"), None),
+        "POST /toggle-task": (toggle_task, None),
+        "POST /add-task (stub LLM)": (add_task, None),
+        "check_tasks_job (all due)": (app.check_tasks_job, make_checks_due),
+    }
+
+
+def run(app, sizes, repeat):
+    """Run every case and return the results keyed by dataset size and case name."""
+    results = {"functions": {}}
+    for name, function in function_cases(app).items():
+        results["functions"][name] = measure(function, repeat * 20)
+        print_result(name, results["functions"][name])
+
+    for size in sizes:
+        print(f"\n--- {size} goals ({size * SUBTASKS_PER_GOAL} subtasks) ---")
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed(app, size)
+        print(f"seeded in {time.perf_counter() - started:.1f}s")
+
+        results[str(size)] = {}
+        for name, (function, setup) in endpoint_cases(app).items():
+            results[str(size)][name] = measure(function, repeat, setup)
+            print_result(name, results[str(size)][name])
+
+    reset_database(app)
+    return results
+
+
+def print_result(name, result):
+    print(f"{name:<40} median {result['median_ms']:>10.3f} ms   p95 {result['p95_ms']:>10.3f} ms   "
+          f"peak {result['peak_kib']:>10.1f} KiB")
+
+
+def compare(results, baseline, tolerance):
+    """Print every case whose median got slower than the baseline by more than `tolerance`. Returns the count."""
+    regressions = 0
+    for group, cases in results.items():
+        for name, result in cases.items():
+            previous = baseline.get("results", {}).get(group, {}).get(name)
+            if not previous or not previous["median_ms"]:
+                continue
+            change = result["median_ms"] / previous["median_ms"] - 1
+            if change > tolerance:
+                regressions += 1
+                print(f"REGRESSION [{group}] {name}: {previous['median_ms']:.3f} ms -> "
+                      f"{result['median_ms']:.3f} ms (+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend's hot functions and endpoints")
+    parser.add_argument("--sizes", default="100,1000", help="Comma separated numbers of goals to seed")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per endpoint case")
+    parser.add_argument("--mongo-uri", help="Benchmark against this MongoDB instead of mongomock")
+    parser.add_argument("--save", help="Write the results to this JSON baseline file")
+    parser.add_argument("--compare", help="Compare against this JSON baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a case fails")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    app = load_app(args.mongo_uri)
+    results = run(app, sizes, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({
+                "created_at": datetime.now().isoformat(),
+                "backend": "mongod" if args.mongo_uri else "mongomock",
+                "json_encoder": "orjson" if app.orjson else "json",
+                "python": platform.python_version(),
+                "results": results
+            }, baseline_file, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"\n{regressions} regressions against {args.compare}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
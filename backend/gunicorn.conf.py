@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for wsgi:app.
+
+The app starts its background threads when a worker imports it, so the app
+must not be preloaded in the master process: threads do not survive fork.
+Threaded workers let long-lived /events streams and slow LLM calls share a
+worker with ordinary requests; every open /events stream holds one of the
+worker's threads, so wsgi.py caps them at half of GUNICORN_THREADS per
+worker and a client over the cap gets a 503. Raise GUNICORN_THREADS for
+many connected clients.
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+preload_app = False
+timeout = 60  # Seconds before a worker that stopped responding to the master is restarted
+graceful_timeout = 30
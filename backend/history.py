@@ -0,0 +1,120 @@
+"""
+Bucketed storage of subtask check-ins and progress notes.
+
+Subtask documents keep only the latest HISTORY_RECENT entries of each kind,
+plus counters, so reading a subtask costs the same however long it has been
+running. Every entry is also appended to a bucket in the history
+collection; a bucket holds up to HISTORY_BUCKET_SIZE entries of one subtask,
+and a new one is started when it fills up. The full history is read back a
+page at a time, newest first.
+"""
+import base64
+import json
+from datetime import datetime
+from bson import ObjectId
+from storage import history_collection, subtasks_collection, next_change_seq, parse_deadline
+
+HISTORY_BUCKET_SIZE = 50  # Entries per bucket document
+HISTORY_RECENT = 5  # Entries of each kind kept on the subtask itself
+HISTORY_KINDS = {"check_in": "check_ins", "progress_note": "progress_notes"}  # kind -> subtask array field
+# Statuses counted separately in history_counts; anything else is counted as "other"
+HISTORY_STATUSES = {"pending", "in_progress", "completed", "delayed", "procrastination"}
+
+
+def new_history_entry(fields, at=None):
+    """Give a check-in or note an id, so its copies on the subtask and in a bucket can be matched."""
+    return {"_id": ObjectId(), **fields, "at": at or datetime.now()}
+
+
+def history_counter(entry):
+    """The history_counts key an entry is counted under besides its kind."""
+    status = entry.get("status") or entry.get("type")
+    return status if status in HISTORY_STATUSES else "other"
+
+
+def recent_history_update(kind, entry):
+    """
+    Build the subtask update that records `entry` in the capped recent window.
+
+    Returns {"$push": ..., "$inc": ...}; merge it into the rest of the update.
+    """
+    return {
+        "$push": {HISTORY_KINDS[kind]: {"$each": [entry], "$slice": -HISTORY_RECENT}},
+        "$inc": {f"history_counts.{kind}": 1, f"history_counts.{history_counter(entry)}": 1}
+    }
+
+
+def append_history(subtask_id, kind, entry, source="api"):
+    """Add `entry` to the subtask's open bucket, starting a new bucket when the last one is full."""
+    history_collection.update_one(
+        {"subtask_id": subtask_id, "count": {"$lt": HISTORY_BUCKET_SIZE}},
+        {
+            "$push": {"entries": {**entry, "kind": kind}},
+            "$inc": {"count": 1},
+            "$min": {"first_at": entry["at"]},
+            "$max": {"last_at": entry["at"]},
+            "$setOnInsert": {"source": source}
+        },
+        upsert=True
+    )
+
+
+def set_history_field(subtask_id, kind, entry_id, field, value):
+    """Update a field of one entry, e.g. attach the LLM's response, on the subtask and in its bucket."""
+    array = HISTORY_KINDS[kind]
+    subtasks_collection.update_one(
+        {"_id": subtask_id, f"{array}._id": entry_id},
+        {"$set": {f"{array}.$.{field}": value, "updated_seq": next_change_seq()}}
+    )
+    history_collection.update_one(
+        {"subtask_id": subtask_id, "entries._id": entry_id},
+        {"$set": {f"entries.$.{field}": value}}
+    )
+
+
+def delete_history(subtask_ids):
+    history_collection.delete_many({"subtask_id": {"$in": list(subtask_ids)}})
+
+
+def encode_history_cursor(entry):
+    """Encode the position of the last returned entry as an opaque cursor."""
+    raw = json.dumps({"t": entry["at"].isoformat(), "i": str(entry["_id"])}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor):
+    """Decode a cursor produced by encode_history_cursor into an (at, entry id) position."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return parse_deadline(data["t"]), ObjectId(data["i"])
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def read_history(subtask_id, limit, before=None, kind=None):
+    """
+    Return (entries, next_cursor): up to `limit` entries older than `before`, newest first.
+
+    Buckets are read newest first until the page is full. Buckets filled by
+    concurrent writers can overlap in time, so reading stops only once the
+    next bucket ends before the oldest entry already collected.
+    """
+    query = {"subtask_id": subtask_id}
+    if before is not None:
+        query["first_at"] = {"$lte": before[0]}
+    entries = []
+    for bucket in history_collection.find(query).sort([("last_at", -1), ("_id", -1)]):
+        if len(entries) > limit and bucket["last_at"] < entries[limit]["at"]:
+            break
+        for entry in bucket["entries"]:
+            if kind is not None and entry["kind"] != kind:
+                continue
+            if before is not None and (entry["at"], entry["_id"]) >= before:
+                continue
+            entries.append(entry)
+        entries.sort(key=lambda entry: (entry["at"], entry["_id"]), reverse=True)
+
+    page = entries[:limit]
+    next_cursor = encode_history_cursor(page[-1]) if len(entries) > limit else None
+    return page, next_cursor
@@ -0,0 +1,128 @@
+"""
+Duplicate suppression for submissions that call the LLM.
+
+SingleFlight makes concurrent callers with the same key share one run of a
+function in this process. IdempotencyStore remembers the response to each
+Idempotency-Key in MongoDB, so a retry of a finished request, from any
+process, is answered without running it again.
+"""
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger("pk-agent.idempotency")
+
+
+class SingleFlight:
+    """
+    Run a function once per key among concurrent callers.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait and get the same result, or the same exception. Nothing
+    is kept once the call finishes, so a later caller runs it again.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> Future of the call in flight
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        """Return (result, shared), where shared is True if another caller's run produced the result."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result(), True
+
+        try:
+            result = function()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
+
+
+class IdempotencyStore:
+    """
+    Stored responses of requests sent with an Idempotency-Key.
+
+    A request claims its key before it runs. The record holds a fingerprint
+    of the request, so a key reused for a different request can be refused,
+    and once the request finishes it holds the response to replay. Records
+    expire after `ttl` through a TTL index on created_at. A running request
+    renews its claim, so a claim that was not renewed within `lease`,
+    because its process died, can be taken over by a retry.
+    """
+
+    def __init__(self, collection, ttl, lease):
+        self.collection = collection
+        self.ttl = ttl
+        self.lease = lease
+
+    def claim(self, key, fingerprint):
+        """
+        Reserve `key` for a request about to run.
+
+        Returns (True, None) if the caller should run the request, or
+        (False, record) with the existing record if the key is taken.
+        """
+        now = datetime.now()
+        fresh = {"fingerprint": fingerprint, "status": "in_progress", "created_at": now, "claimed_at": now}
+        try:
+            self.collection.insert_one({"_id": key, **fresh})
+            return True, None
+        except DuplicateKeyError:
+            record = self.collection.find_one({"_id": key})
+
+        if record is None:
+            # Expired and removed since the insert failed
+            return self.claim(key, fingerprint)
+
+        # TTL removal is lazy, and a stale claim belongs to a request that will never finish
+        expired = record["created_at"] <= now - self.ttl
+        abandoned = (record["status"] == "in_progress" and record["fingerprint"] == fingerprint
+                     and record["claimed_at"] <= now - self.lease)
+        if expired or abandoned:
+            result = self.collection.replace_one(
+                {"_id": key, "status": record["status"], "claimed_at": record["claimed_at"]},
+                fresh
+            )
+            if result.modified_count:
+                return True, None
+            return False, self.collection.find_one({"_id": key}) or record
+        return False, record
+
+    def renew(self, key, fingerprint, finished):
+        """Renew the claim on `key` every third of the lease until `finished` is set, so a long request keeps it."""
+        while not finished.wait(self.lease.total_seconds() / 3):
+            try:
+                self.collection.update_one(
+                    {"_id": key, "status": "in_progress", "fingerprint": fingerprint},
+                    {"$set": {"claimed_at": datetime.now()}}
+                )
+            except Exception as e:
+                logger.error("Error renewing idempotency claim %s: %s", key, e)
+
+    def complete(self, key, response):
+        """Store the response of a claimed request so retries replay it."""
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"status": "completed", "response": response, "completed_at": datetime.now()}}
+        )
+
+    def release(self, key):
+        """Drop an unfinished claim, e.g. after a server error, so the request can be retried."""
+        self.collection.delete_one({"_id": key, "status": "in_progress"})
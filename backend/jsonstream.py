@@ -0,0 +1,101 @@
+"""
+Incremental parsing of a JSON array that arrives in chunks.
+
+The model streams its breakdown as a JSON array of subtask objects. Rather
+than waiting for the whole reply, JSONArrayParser hands back each element as
+soon as its closing bracket arrives, so a reply cut off midway still yields
+every element that was complete, and one malformed element does not cost
+the others.
+"""
+import json
+
+WHITESPACE = " \t\r\n"
+# What may follow the opening bracket of the reply: an array of objects, or one object
+REPLY_STARTS = {"[": "{]", "{": "\"}"}
+
+
+class JSONArrayParser:
+    """
+    Split a streamed JSON array into its elements.
+
+    The reply starts at the first "[" followed by "{" or "]", or "{" followed
+    by a quote or "}", ignoring whitespace in between. Anything before it (a
+    markdown fence, a sentence of preamble such as "here are [3] steps") and
+    anything after the array closes is ignored. A reply that is a single
+    object instead of an array is treated as an array of one. Only the
+    element being read is buffered.
+    """
+
+    def __init__(self):
+        self.top = None  # "[" or "{" once the reply has started
+        self.opener = None  # A bracket that starts the reply if the next non-whitespace character fits
+        self.closed = False  # True once the top-level value has ended
+        self.depth = 0  # Bracket nesting, counting the top-level array
+        self.in_string = False
+        self.escaped = False
+        self.item = []  # Characters of the element being read
+
+    def feed(self, text):
+        """
+        Consume a chunk of the reply and yield (value, error) for every element it completes.
+
+        `value` is the parsed element, or None with `error` describing why
+        the element's text is not valid JSON.
+        """
+        for char in text:
+            if self.closed:
+                return
+            if self.top is None:
+                if self.opener is not None and char not in WHITESPACE:
+                    opener, self.opener = self.opener, None
+                    if char in REPLY_STARTS[opener]:
+                        self.top, self.depth = opener, 1
+                        if opener == "{":
+                            # A bare object: read it as the one element of an implicit array
+                            self.item.append(opener)
+                if self.top is None:
+                    if char in REPLY_STARTS:
+                        self.opener = char
+                    continue
+
+            if self.in_string:
+                self.item.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if self.top == "[" and self.depth == 1:
+                # Between elements, or inside a scalar element, of the top-level array
+                if char in ",]":
+                    if self.item:
+                        yield self._finish_item()
+                    if char == "]":
+                        self.closed = True
+                    continue
+                if not self.item and char in WHITESPACE:
+                    continue
+
+            self.item.append(char)
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.top == "{" and self.depth == 0:
+                    self.closed = True
+                    yield self._finish_item()
+                elif self.top == "[" and self.depth == 1:
+                    yield self._finish_item()
+
+    def _finish_item(self):
+        text = "".join(self.item).strip()
+        self.item = []
+        try:
+            return json.loads(text), None
+        except ValueError as e:
+            return None, f"Malformed element: {e}"
@@ -0,0 +1,98 @@
+"""
+Leader election through a lease document in MongoDB.
+
+Several processes can serve the app, but the scheduled jobs must run in only
+one of them. Each process runs a Lease: whichever holds the lease document
+renews it every few seconds and is the leader; the others keep trying to take
+it and succeed once it has expired, i.e. when the leader stopped renewing it.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger("pk-agent.lease")
+
+
+class Lease:
+    """
+    A named lease held by at most one process at a time.
+
+    The holder renews it every `renew_interval`; others take it over once it
+    has gone `ttl` without renewal. The holder considers itself the leader
+    only until `ttl` after its last successful renewal, measured locally, so
+    a process cut off from MongoDB steps down before anyone else can take
+    over. Expiry in the document uses the local clock of the process that
+    wrote it, so hosts need synchronized clocks.
+    """
+
+    def __init__(self, collection, name, ttl=timedelta(seconds=30), renew_interval=timedelta(seconds=10),
+                 on_acquired=None):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.on_acquired = on_acquired
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.held_until = None  # time.monotonic() at which our hold lapses
+        self.stopped = threading.Event()
+
+    def is_held(self):
+        held_until = self.held_until
+        return held_until is not None and time.monotonic() < held_until
+
+    def try_acquire(self):
+        """Take or renew the lease. Returns True while this process holds it."""
+        started = time.monotonic()
+        now = datetime.now()
+        try:
+            document = self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {
+                    "$set": {"owner": self.owner, "expires_at": now + self.ttl, "renewed_at": now},
+                    "$setOnInsert": {"acquired_at": now}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lease exists, is held by someone else and has not expired
+            document = None
+        if document is None or document["owner"] != self.owner:
+            self.held_until = None
+            return False
+        self.held_until = started + self.ttl.total_seconds()
+        return True
+
+    def release(self):
+        """Give the lease up, so another process can take over without waiting for it to expire."""
+        self.stopped.set()
+        if self.held_until is None:
+            return
+        self.held_until = None
+        try:
+            self.collection.delete_one({"_id": self.name, "owner": self.owner})
+        except Exception as e:
+            logger.warning("Error releasing the %s lease: %s", self.name, e)
+
+    def run(self):
+        """Keep trying to take or renew the lease until release() is called."""
+        while not self.stopped.is_set():
+            was_held = self.is_held()
+            try:
+                held = self.try_acquire()
+            except Exception as e:
+                logger.error("Error renewing the %s lease: %s", self.name, e)
+                held = self.is_held()
+            if held and not was_held:
+                logger.info("Acquired the %s lease", self.name, extra={"owner": self.owner})
+                if self.on_acquired:
+                    self.on_acquired()
+            elif was_held and not held:
+                logger.warning("Lost the %s lease", self.name, extra={"owner": self.owner})
+            self.stopped.wait(self.renew_interval.total_seconds())
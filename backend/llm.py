@@ -0,0 +1,355 @@
+"""
+Resilient gateway in front of the DeepSeek chat completions API.
+
+Every LLM call in the app goes through one LLMGateway, which owns the HTTP
+connection pool and applies the same policy everywhere: a per-route deadline,
+a cap on concurrent requests, jittered retries on 429/5xx, optional hedging
+and a circuit breaker. Callers catch LLMUnavailableError to fall back to
+their canned responses.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import openai
+from openai import OpenAI
+from metrics import LLM_REQUEST_DURATION, LLM_TOKENS, LLM_ERRORS, LLM_REQUEST_TOKENS, LLM_TRUNCATED
+
+logger = logging.getLogger("pk-agent.llm")
+
+
+class LLMUnavailableError(Exception):
+    """The LLM could not answer in time; callers should fall back to a canned response."""
+
+
+class LLMTimeoutError(LLMUnavailableError):
+    """The route's deadline passed before the LLM answered."""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+
+def is_transient(error):
+    """True for failures worth retrying and counting against the circuit breaker: timeouts, 429s and 5xx."""
+    if isinstance(error, (LLMTimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    Stop calling an API that keeps failing.
+
+    After `failure_threshold` consecutive transient failures the circuit
+    opens and calls fail immediately. Once `reset_timeout` seconds have
+    passed a single trial call is let through (half-open); its outcome
+    closes the circuit again or keeps it open for another period.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """Return True if a call may go ahead."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End a call that says nothing about the API's health, e.g. a 400 or a local error."""
+        with self.lock:
+            self.probing = False
+
+
+class LLMGateway:
+    """
+    Shared, bounded and fault tolerant access to chat completions.
+
+    `deadlines` maps a route name to the seconds its call may take in total,
+    across every retry and hedge; routes in `hedged_routes` send a second,
+    identical request when the first is slower than the route's recent
+    `hedge_percentile` latency. `output_budgets` maps a route name to the
+    most tokens its replies may use; it is sent as max_tokens, and a larger
+    max_tokens from the caller is lowered to it. Route names label the LLM
+    metrics. The `client` attribute can be swapped for a stub in tests, or
+    `base_url` pointed at a local stub server.
+    """
+
+    def __init__(self, api_key, base_url, model, deadlines=None, hedged_routes=(), default_deadline=30,
+                 output_budgets=None, max_concurrency=8, max_retries=2, backoff_base=0.5, backoff_cap=8,
+                 hedge_percentile=0.95, hedge_min_samples=20, failure_threshold=5, reset_timeout=30,
+                 connect_timeout=5):
+        self.model = model
+        self.deadlines = dict(deadlines or {})
+        self.output_budgets = dict(output_budgets or {})
+        self.hedged_routes = set(hedged_routes)
+        self.default_deadline = default_deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        # One keep-alive pool for every thread; hedges may briefly double the in-flight requests
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_concurrency * 2, max_keepalive_connections=max_concurrency),
+            timeout=httpx.Timeout(default_deadline, connect=connect_timeout)
+        )
+        # Retries are done here, where they can respect the route deadline
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=0)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency * 2, thread_name_prefix="llm-hedge")
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.latencies = {}  # route -> recent successful call durations in seconds
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0, "rejected": 0}
+        self.lock = threading.Lock()
+
+    def complete(self, route, messages, **kwargs):
+        """Return the text of the model's reply to `messages`, within the deadline of `route`."""
+        deadline = self._start(route)
+        kwargs = self._apply_budget(route, kwargs)
+        try:
+            response = self._with_retries(lambda: self._hedged_attempt(route, deadline, messages, kwargs), deadline)
+        except Exception as e:
+            self._finish(route, e)
+            if is_transient(e) and not isinstance(e, LLMUnavailableError):
+                raise LLMUnavailableError(f"LLM request failed: {str(e)}") from e
+            raise
+        self._finish(route, None)
+        self._check_truncation(route, getattr(response.choices[0], "finish_reason", None))
+        return response.choices[0].message.content
+
+    def stream(self, route, messages, **kwargs):
+        """
+        Yield the model's reply to `messages` chunk by chunk.
+
+        Retries only cover opening the stream, and the deadline bounds the
+        wait for each chunk rather than the whole reply. A connection slot is
+        held until the stream is exhausted or closed.
+        """
+        deadline = self._start(route)
+        kwargs = self._apply_budget(route, kwargs)
+        try:
+            self._acquire_slot(deadline)
+            started = time.monotonic()
+            outcome = "error"
+            try:
+                # Streams only report token usage when asked, in a final chunk without choices
+                stream_kwargs = dict(kwargs, stream=True, stream_options={"include_usage": True})
+                chunks = self._with_retries(lambda: self._create(deadline, messages, stream_kwargs), deadline)
+                for chunk in chunks:
+                    self._record_usage(route, getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    self._check_truncation(route, getattr(chunk.choices[0], "finish_reason", None))
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+                outcome = "ok"
+            finally:
+                self.slots.release()
+                LLM_REQUEST_DURATION.observe(time.monotonic() - started, call_site=route, outcome=outcome)
+        except GeneratorExit:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self._finish(route, e)
+            if is_transient(e) and not isinstance(e, LLMUnavailableError):
+                raise LLMUnavailableError(f"LLM stream failed: {str(e)}") from e
+            raise
+        self._finish(route, None)
+
+    def snapshot(self):
+        """Counters and circuit state for monitoring."""
+        with self.lock:
+            stats = dict(self.stats)
+        stats["circuit"] = self.breaker.state
+        return stats
+
+    def _start(self, route):
+        """Count a call, refuse it if the circuit is open and return its absolute deadline."""
+        self._count("calls")
+        if not self.breaker.allow():
+            self._count("rejected")
+            LLM_ERRORS.inc(call_site=route, error=CircuitOpenError.__name__)
+            raise CircuitOpenError("LLM circuit breaker is open")
+        return time.monotonic() + self.deadlines.get(route, self.default_deadline)
+
+    def _apply_budget(self, route, kwargs):
+        """Cap max_tokens at the route's output budget."""
+        budget = self.output_budgets.get(route)
+        if budget is None:
+            return kwargs
+        return dict(kwargs, max_tokens=min(kwargs.get("max_tokens") or budget, budget))
+
+    def _check_truncation(self, route, finish_reason):
+        if finish_reason == "length":
+            LLM_TRUNCATED.inc(call_site=route)
+            logger.warning("LLM reply was cut off by the output budget", extra={"call_site": route})
+
+    def _finish(self, route, error):
+        """Report the outcome of a call to the circuit breaker and the error metrics."""
+        if error is None:
+            self.breaker.record_success()
+            return
+        LLM_ERRORS.inc(call_site=route, error=type(error).__name__)
+        if is_transient(error):
+            self._count("failures")
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    def _with_retries(self, call, deadline):
+        """Run `call`, retrying transient failures with jittered exponential backoff while the deadline allows."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                if not is_transient(e) or isinstance(e, LLMTimeoutError) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                self._count("retries")
+                logger.warning("LLM request failed (%s), retrying in %.2fs", e, delay)
+                time.sleep(delay)
+
+    def _backoff(self, attempt, error):
+        """Full-jitter backoff, stretched to the server's Retry-After when it sends one."""
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    def _hedged_attempt(self, route, deadline, messages, kwargs):
+        """
+        One attempt, with a backup request if the first is slower than usual.
+
+        The backup is sent only once enough latencies are known for the route
+        and a connection slot is free; whichever request succeeds first wins
+        and the other is left to finish in the background.
+        """
+        delay = self._hedge_delay(route)
+        if delay is None or time.monotonic() + delay >= deadline:
+            return self._attempt(route, deadline, messages, kwargs)
+
+        first = self.executor.submit(self._attempt, route, deadline, messages, kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self._count("hedges")
+        second = self.executor.submit(self._attempt, route, deadline, messages, kwargs, False)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _hedge_delay(self, route):
+        """How long to wait before hedging a call on `route`, or None if it is not hedged."""
+        if route not in self.hedged_routes:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies.get(route, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    def _attempt(self, route, deadline, messages, kwargs, wait_for_slot=True):
+        """Make one request while holding a connection slot, and record how long it took."""
+        if wait_for_slot:
+            self._acquire_slot(deadline)
+        elif not self.slots.acquire(blocking=False):
+            # A hedge is never worth waiting for a slot; let the first request finish
+            raise LLMUnavailableError("No free LLM connection slot for a hedged request")
+        started = time.monotonic()
+        try:
+            response = self._create(deadline, messages, kwargs)
+        except Exception:
+            LLM_REQUEST_DURATION.observe(time.monotonic() - started, call_site=route, outcome="error")
+            raise
+        finally:
+            self.slots.release()
+        elapsed = time.monotonic() - started
+        LLM_REQUEST_DURATION.observe(elapsed, call_site=route, outcome="ok")
+        self._record_usage(route, getattr(response, "usage", None))
+        with self.lock:
+            self.latencies.setdefault(route, deque(maxlen=200)).append(elapsed)
+        return response
+
+    def _record_usage(self, route, usage):
+        """Count the prompt and completion tokens the API reported for a response."""
+        if usage is None:
+            return
+        for kind in ("prompt", "completion"):
+            tokens = getattr(usage, f"{kind}_tokens", 0) or 0
+            LLM_TOKENS.inc(tokens, call_site=route, kind=kind)
+            LLM_REQUEST_TOKENS.observe(tokens, call_site=route, kind=kind)
+
+    def _acquire_slot(self, deadline):
+        if not self.slots.acquire(timeout=max(0, deadline - time.monotonic())):
+            raise LLMUnavailableError("All LLM connection slots are busy")
+
+    def _create(self, deadline, messages, kwargs):
+        """Call the API with whatever is left of the deadline as its timeout."""
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise LLMTimeoutError("LLM deadline exceeded")
+        try:
+            return self.client.chat.completions.create(model=self.model, messages=messages, timeout=timeout, **kwargs)
+        except openai.APITimeoutError as e:
+            raise LLMTimeoutError(f"LLM request timed out after {timeout:.1f}s") from e
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
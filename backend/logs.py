@@ -0,0 +1,150 @@
+"""
+Structured, queue-backed logging for the API and its background threads.
+
+Log calls only put the record on an in-memory queue; a QueueListener thread
+formats and writes it, so slow stdout never holds up a request. Every record
+carries the request id and route of the request that emitted it, and the
+INFO/DEBUG output of busy routes can be sampled per request.
+
+Configuration (environment):
+    LOG_LEVEL: minimum level, default INFO
+    LOG_FORMAT: json (default) or text
+    LOG_SAMPLE_RATES: comma separated route=rate pairs, e.g. "/subtasks=0.1".
+        Warnings and errors are always kept.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from contextlib import contextmanager
+from datetime import datetime
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+route_var = contextvars.ContextVar("route", default="-")
+sampled_var = contextvars.ContextVar("sampled", default=True)
+
+# Attributes every LogRecord has; anything else was passed through `extra` and is logged as a field
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+DEFAULT_SAMPLE_RATES = {
+    "/metrics": 0.0,
+    "/events": 0.1,
+}
+
+
+def parse_sample_rates(value):
+    """Parse LOG_SAMPLE_RATES ("route=rate,...") on top of DEFAULT_SAMPLE_RATES."""
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for pair in (value or "").split(","):
+        if "=" not in pair:
+            continue
+        route, rate = pair.rsplit("=", 1)
+        try:
+            rates[route.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the current request id and route, and drop unsampled INFO/DEBUG records."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.route = route_var.get()
+        return record.levelno >= logging.WARNING or sampled_var.get()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with `extra` fields as top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human readable lines for local development, with `extra` fields appended as key=value."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(
+            f"{key}={value}" for key, value in vars(record).items()
+            if key not in STANDARD_ATTRIBUTES and key not in ("request_id", "route")
+        )
+        return f"{line} {fields}" if fields else line
+
+
+listener = None
+
+
+def configure_logging():
+    """
+    Send the app's log records through a queue to a single writer thread.
+
+    Safe to call more than once; only the first call installs the handlers.
+    """
+    global listener
+    if listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "json") == "text":
+        stream_handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s [%(request_id)s %(route)s] %(message)s"))
+    else:
+        stream_handler.setFormatter(JSONFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Stamp the context on the request thread, before the record crosses to the listener
+    queue_handler.addFilter(ContextFilter())
+
+    logger = logging.getLogger("pk-agent")
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def start_request_context(request_id, route):
+    """Bind a request id and route to the current context and decide whether its INFO logs are sampled."""
+    request_id_var.set(request_id)
+    route_var.set(route)
+    sampled_var.set(random.random() < SAMPLE_RATES.get(route, 1.0))
+
+
+def clear_request_context():
+    request_id_var.set("-")
+    route_var.set("-")
+    sampled_var.set(True)
+
+
+@contextmanager
+def log_context(request_id, route="-"):
+    """Tag the logs of a background unit of work, such as a queued job, like a request."""
+    tokens = [request_id_var.set(request_id), route_var.set(route), sampled_var.set(True)]
+    try:
+        yield
+    finally:
+        for var, token in zip((request_id_var, route_var, sampled_var), tokens):
+            var.reset(token)
@@ -0,0 +1,513 @@
+"""
+Maintenance commands for the task database.
+
+Usage:
+    python manage.py split-collections [--batch-size N] [--reset]
+    python manage.py backfill-dates [--batch-size N] [--reset]
+    python manage.py migrate-history [--batch-size N] [--reset]
+    python manage.py normalize-subtasks [--batch-size N]
+    python manage.py backfill-stats [--batch-size N]
+
+Commands import the storage layer directly rather than app.py, so running one
+does not start the scheduler, job workers or the Flask app.
+"""
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne, ReplaceOne
+from storage import (
+    goals_collection, subtasks_collection, legacy_tasks_collection, migrations_collection, history_collection,
+    stats_collection, ensure_indexes, insert_documents, next_change_seq, parse_deadline
+)
+from history import HISTORY_BUCKET_SIZE, HISTORY_RECENT, HISTORY_KINDS, history_counter
+from stats import stats_increments, stats_day
+
+
+def legacy_subtask_fields(subtask, goal_id, goal, seq, now):
+    """
+    Normalize a subtask from the old mixed collection into the shape the API now stores.
+
+    Missing fields get the same defaults the old /subtasks listing filled in
+    at read time.
+    """
+    motivation_tips = subtask.get("motivation_tips") or []
+    if not isinstance(motivation_tips, list):
+        motivation_tips = [motivation_tips]
+    completed = bool(subtask.get("completed", False))
+    return {
+        "parent_goal_id": goal_id,
+        "parent_goal": goal or "Untitled",
+        "task": subtask.get("task") or "Untitled Task",
+        "time_required": subtask.get("time_required") or "Not specified",
+        "estimated_hours": subtask.get("estimated_hours", 1),
+        "deadline": parse_deadline(subtask.get("deadline")) or now + timedelta(weeks=1),
+        "motivation_tips": motivation_tips,
+        "checkpoints": subtask.get("checkpoints") or [],
+        "completed": completed,
+        "completed_at": parse_deadline(subtask.get("completed_at")),
+        "status": subtask.get("status") or ("completed" if completed else "pending"),
+        "check_ins": subtask.get("check_ins") or [],
+        "progress_notes": subtask.get("progress_notes") or [],
+        "check_in_count": subtask.get("check_in_count", 0),
+        "last_check_in": subtask.get("last_check_in"),
+        # Let the check-in scheduler re-evaluate every open subtask once
+        "next_check_at": None if completed else now,
+        "created_at": parse_deadline(subtask.get("created_at")) or now,
+        "updated_seq": seq
+    }
+
+
+def copy_subtask(subtask, key, goal_id, goal, seq, now):
+    """Insert one subtask unless an earlier run already copied it. Returns 1 if it was inserted."""
+    fields = legacy_subtask_fields(subtask, goal_id, goal, seq, now)
+    if "legacy_key" in key:
+        fields["legacy_key"] = key["legacy_key"]
+    result = subtasks_collection.update_one(key, {"$setOnInsert": fields}, upsert=True)
+    return 1 if result.upserted_id else 0
+
+
+def goal_id_for_text(goal, seq, now):
+    """
+    Find or create the goal document that flat /breakdown subtasks are grouped under.
+
+    Returns (goal_id, created).
+    """
+    goal = goal or "Untitled"
+    result = goals_collection.update_one(
+        {"goal": goal},
+        {"$setOnInsert": {"goal": goal, "created_at": now, "status": "active", "updated_seq": seq}},
+        upsert=True
+    )
+    if result.upserted_id:
+        return result.upserted_id, True
+    return goals_collection.find_one({"goal": goal}, {"_id": 1})["_id"], False
+
+
+def migrate_legacy_document(document, seq, now):
+    """
+    Copy one document from the old tasks collection into goals and subtasks.
+
+    The old collection held two shapes: goal documents with an embedded
+    `subtasks` array (from /add-task) and standalone subtask documents with a
+    `parent_goal` string (from /breakdown). Returns (goals, subtasks) copied.
+    """
+    if "subtasks" in document or "goal" in document:
+        goal_id = document["_id"]
+        result = goals_collection.update_one(
+            {"_id": goal_id},
+            {"$setOnInsert": {
+                "goal": document.get("goal") or "Untitled",
+                "created_at": parse_deadline(document.get("created_at")) or now,
+                "status": document.get("status") or "active",
+                "updated_seq": seq
+            }},
+            upsert=True
+        )
+        copied = 0
+        for index, subtask in enumerate(document.get("subtasks") or []):
+            subtask_id = subtask.get("_id")
+            if subtask_id is not None and ObjectId.is_valid(subtask_id):
+                key = {"_id": ObjectId(subtask_id)}
+            else:
+                # Same fallback id scheme the old listing used for subtasks without one
+                key = {"legacy_key": f"{goal_id}-{index}"}
+            copied += copy_subtask(subtask, key, goal_id, document.get("goal"), seq, now)
+        return (1 if result.upserted_id else 0), copied
+
+    goal_id, created = goal_id_for_text(document.get("parent_goal"), seq, now)
+    copied = copy_subtask(document, {"_id": document["_id"]}, goal_id, document.get("parent_goal"), seq, now)
+    return (1 if created else 0), copied
+
+
+def split_collections(batch_size, reset=False):
+    """
+    Copy the old mixed `tasks` collection into `goals` and `subtasks`.
+
+    Progress is checkpointed after every batch, so an interrupted run picks up
+    where it stopped and re-running a finished migration is a no-op. The old
+    collection is left untouched.
+    """
+    migration_id = "split-collections"
+    if reset:
+        migrations_collection.delete_one({"_id": migration_id})
+
+    progress = migrations_collection.find_one({"_id": migration_id}) or {}
+    if progress.get("completed_at"):
+        print(f"Migration already completed at {progress['completed_at']}, use --reset to run it again")
+        return
+
+    ensure_indexes()
+    last_id = progress.get("last_id")
+    goals_copied = progress.get("goals", 0)
+    subtasks_copied = progress.get("subtasks", 0)
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(legacy_tasks_collection.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        seq = next_change_seq()
+        now = datetime.now()
+        for document in batch:
+            goals, subtasks = migrate_legacy_document(document, seq, now)
+            goals_copied += goals
+            subtasks_copied += subtasks
+
+        last_id = batch[-1]["_id"]
+        migrations_collection.update_one(
+            {"_id": migration_id},
+            {"$set": {"last_id": last_id, "goals": goals_copied, "subtasks": subtasks_copied, "updated_at": now}},
+            upsert=True
+        )
+        print(f"Copied {goals_copied} goals and {subtasks_copied} subtasks (up to {last_id})")
+
+    migrations_collection.update_one(
+        {"_id": migration_id},
+        {"$set": {"completed_at": datetime.now()}},
+        upsert=True
+    )
+    print(f"Migration complete: {goals_copied} goals and {subtasks_copied} subtasks")
+
+
+# Fields stored as ISO strings before dates were stored as BSON dates
+DATE_FIELDS = {
+    "goals": ["created_at"],
+    "subtasks": ["deadline", "created_at", "completed_at"],
+}
+
+
+def date_updates(document, fields, seq):
+    """Build the $set converting a document's string date fields, or None if none parse."""
+    updates = {}
+    for field in fields:
+        value = document.get(field)
+        if isinstance(value, str):
+            parsed = parse_deadline(value)
+            if parsed is not None:
+                updates[field] = parsed
+            else:
+                print(f"Skipping unparseable {field} {value!r} on {document['_id']}")
+    if not updates:
+        return None
+    updates["updated_seq"] = seq
+    return {"$set": updates}
+
+
+def backfill_dates(batch_size, reset=False):
+    """
+    Convert deadline, created_at and completed_at strings into BSON dates.
+
+    Only documents that still hold a string in one of those fields are read,
+    and each batch is written with a single bulk_write. Progress is
+    checkpointed per collection, so an interrupted run resumes where it
+    stopped.
+    """
+    migration_id = "backfill-dates"
+    if reset:
+        migrations_collection.delete_one({"_id": migration_id})
+    progress = migrations_collection.find_one({"_id": migration_id}) or {}
+
+    for collection in (goals_collection, subtasks_collection):
+        fields = DATE_FIELDS[collection.name]
+        last_id = progress.get(collection.name)
+        converted = 0
+        while True:
+            query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = list(collection.find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size))
+            if not batch:
+                break
+
+            seq = next_change_seq()
+            operations = []
+            for document in batch:
+                update = date_updates(document, fields, seq)
+                if update:
+                    operations.append(UpdateOne({"_id": document["_id"]}, update))
+            if operations:
+                converted += collection.bulk_write(operations, ordered=False).modified_count
+
+            last_id = batch[-1]["_id"]
+            migrations_collection.update_one(
+                {"_id": migration_id},
+                {"$set": {collection.name: last_id, "updated_at": datetime.now()}},
+                upsert=True
+            )
+        print(f"Converted dates on {converted} {collection.name}")
+
+    print("Date backfill complete")
+
+
+def history_buckets(subtask_id, kind_entries):
+    """Pack (kind, entry) pairs, oldest first, into full bucket documents."""
+    buckets = []
+    for start in range(0, len(kind_entries), HISTORY_BUCKET_SIZE):
+        chunk = kind_entries[start:start + HISTORY_BUCKET_SIZE]
+        buckets.append({
+            "subtask_id": subtask_id,
+            "entries": [{**entry, "kind": kind} for kind, entry in chunk],
+            "count": len(chunk),
+            "first_at": chunk[0][1]["at"],
+            "last_at": chunk[-1][1]["at"],
+            "source": "migration"
+        })
+    return buckets
+
+
+def migrate_subtask_history(subtask, seq):
+    """
+    Move one subtask's embedded check-ins and notes into history buckets.
+
+    Entries written before bucketing have no _id; they get one, are copied
+    into buckets and counted in history_counts, and the subtask keeps only
+    the latest HISTORY_RECENT of each kind. Entries that already have an _id
+    were bucketed by the API and are left alone. Buckets from an interrupted
+    earlier attempt are replaced, so running this twice copies nothing twice.
+    Returns the number of entries moved.
+    """
+    history_collection.delete_many({"subtask_id": subtask["_id"], "source": "migration"})
+
+    legacy = []
+    update = {"$set": {"updated_seq": seq}, "$inc": {}}
+    fallback_at = parse_deadline(subtask.get("created_at")) or datetime.now()
+    for kind, field in HISTORY_KINDS.items():
+        entries = []
+        for entry in subtask.get(field) or []:
+            if "_id" not in entry:
+                entry = {"_id": ObjectId(), **entry, "at": parse_deadline(entry.get("timestamp")) or fallback_at}
+                legacy.append((kind, entry))
+                for counter in (kind, history_counter(entry)):
+                    key = f"history_counts.{counter}"
+                    update["$inc"][key] = update["$inc"].get(key, 0) + 1
+            entries.append(entry)
+        entries.sort(key=lambda entry: entry.get("at") or fallback_at)
+        update["$set"][field] = entries[-HISTORY_RECENT:]
+
+    legacy.sort(key=lambda kind_entry: kind_entry[1]["at"])
+    inserted, failures = insert_documents(history_collection, history_buckets(subtask["_id"], legacy))
+    if failures:
+        raise RuntimeError(f"Could not store history buckets for {subtask['_id']}: {failures}")
+    if not update["$inc"]:
+        del update["$inc"]
+    subtasks_collection.update_one({"_id": subtask["_id"]}, update)
+    return len(legacy)
+
+
+def migrate_history(batch_size, reset=False):
+    """
+    Move check-ins and progress notes embedded in subtasks into the history collection.
+
+    Only subtasks holding entries from before bucketing are read. Progress
+    is checkpointed after every batch, so an interrupted run resumes where
+    it stopped.
+    """
+    migration_id = "migrate-history"
+    if reset:
+        migrations_collection.delete_one({"_id": migration_id})
+    progress = migrations_collection.find_one({"_id": migration_id}) or {}
+
+    ensure_indexes()
+    last_id = progress.get("last_id")
+    moved = progress.get("entries", 0)
+    while True:
+        query = {"$or": [
+            {field: {"$elemMatch": {"_id": {"$exists": False}}}} for field in HISTORY_KINDS.values()
+        ]}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(subtasks_collection.find(
+            query, {"created_at": 1, **{field: 1 for field in HISTORY_KINDS.values()}}
+        ).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        seq = next_change_seq()
+        for subtask in batch:
+            moved += migrate_subtask_history(subtask, seq)
+
+        last_id = batch[-1]["_id"]
+        migrations_collection.update_one(
+            {"_id": migration_id},
+            {"$set": {"last_id": last_id, "entries": moved, "updated_at": datetime.now()}},
+            upsert=True
+        )
+        print(f"Moved {moved} history entries (up to {last_id})")
+
+    print(f"History migration complete: {moved} entries moved")
+
+
+# Conditions matching a subtask row that does not have the shape new_subtask_document writes
+MALFORMED_SUBTASK = [
+    {"task": {"$in": [None, ""]}},
+    {"time_required": {"$in": [None, ""]}},
+    {"deadline": {"$not": {"$type": "date"}}},
+    {"motivation_tips": {"$not": {"$type": "array"}}},
+    {"checkpoints": {"$not": {"$type": "array"}}},
+    {"completed": {"$not": {"$type": "bool"}}},
+    {"status": {"$in": [None, ""]}},
+    {"parent_goal": {"$in": [None, ""]}},
+    {"updated_seq": {"$exists": False}},
+]
+
+
+def subtask_row_repairs(subtask, seq, now):
+    """Build the $set that gives one malformed subtask the normalized shape, with the migration's defaults."""
+    expected = legacy_subtask_fields(subtask, subtask.get("parent_goal_id"), subtask.get("parent_goal"), seq, now)
+    if not isinstance(expected["checkpoints"], list):
+        expected["checkpoints"] = [expected["checkpoints"]]
+    repairs = {}
+    for field in ("task", "time_required", "deadline", "motivation_tips", "checkpoints", "completed", "status",
+                  "parent_goal"):
+        value = subtask.get(field)
+        if value != expected[field] or type(value) is not type(expected[field]):
+            repairs[field] = expected[field]
+    if repairs or "updated_seq" not in subtask:
+        repairs["updated_seq"] = seq
+    return repairs
+
+
+def normalize_subtasks(batch_size):
+    """
+    Rewrite subtask rows that do not have the normalized shape the API reads.
+
+    The subtasks collection is the flattened listing itself: /subtasks and
+    /get-tasks serve its rows as stored and never fill in defaults, so every
+    row must look like new_subtask_document's output. Rows written by older
+    code, or edited by hand, are found with a collection scan for
+    MALFORMED_SUBTASK and repaired in bulk; repaired rows get a new
+    updated_seq so delta sync clients fetch them again. Re-running only
+    touches rows that are still malformed.
+    """
+    repaired = 0
+    last_id = None
+    while True:
+        query = {"$or": MALFORMED_SUBTASK}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(subtasks_collection.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        seq = next_change_seq()
+        now = datetime.now()
+        operations = []
+        for subtask in batch:
+            repairs = subtask_row_repairs(subtask, seq, now)
+            if repairs:
+                operations.append(UpdateOne({"_id": subtask["_id"]}, {"$set": repairs}))
+        if operations:
+            repaired += subtasks_collection.bulk_write(operations, ordered=False).modified_count
+        last_id = batch[-1]["_id"]
+
+    print(f"Normalized {repaired} subtasks")
+
+
+def nest_paths(paths):
+    """Turn {"a.b": 1} into {"a": {"b": 1}}."""
+    document = {}
+    for path, value in paths.items():
+        *parents, leaf = path.split(".")
+        target = document
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[leaf] = value
+    return document
+
+
+def backfill_stats(batch_size):
+    """
+    Rebuild the daily stats rollups from the subtasks and the history buckets.
+
+    Completions are counted on the day of each subtask's completed_at,
+    check-ins and procrastination notes on the day they were recorded, the
+    same way the API counts them as they happen. Run migrate-history first,
+    so that older check-ins are in the history collection. Reopened subtasks
+    leave no trace and cannot be rebuilt.
+
+    Every rebuilt bucket is replaced, so re-running gives the same result,
+    but counts the API adds while this runs may be overwritten. Run it while
+    writes are paused.
+    """
+    ensure_indexes()
+    counters = {}  # (goal_id, day) -> Counter of dotted counter paths
+    texts = {}  # (goal_id, day) -> reason texts by dotted path
+
+    def add(goal_id, at, **change):
+        increments, reason_texts = stats_increments(**change)
+        key = (goal_id, stats_day(at))
+        counters.setdefault(key, Counter()).update(increments)
+        texts.setdefault(key, {}).update(reason_texts)
+
+    goal_ids = {}
+    for subtask in subtasks_collection.find({}, {"parent_goal_id": 1, "completed": 1, "completed_at": 1}):
+        goal_ids[subtask["_id"]] = subtask["parent_goal_id"]
+        completed_at = parse_deadline(subtask.get("completed_at"))
+        if subtask.get("completed") and completed_at:
+            add(subtask["parent_goal_id"], completed_at, counts={"completed": 1})
+
+    for bucket in history_collection.find({}, {"subtask_id": 1, "entries": 1}):
+        goal_id = goal_ids.get(bucket["subtask_id"])
+        if goal_id is None:
+            continue
+        for entry in bucket["entries"]:
+            if entry["kind"] == "check_in":
+                status = entry.get("status") or "in_progress"
+                add(goal_id, entry["at"], counts={"check_ins": 1}, status=status,
+                    reason=entry.get("reason") if status != "completed" else None)
+            elif entry.get("type") == "procrastination":
+                add(goal_id, entry["at"], counts={"procrastination_notes": 1}, reason=entry.get("reason"))
+
+    operations = [
+        ReplaceOne(
+            {"goal_id": goal_id, "day": day},
+            {"goal_id": goal_id, "day": day, **nest_paths({**counters[(goal_id, day)], **texts[(goal_id, day)]})},
+            upsert=True
+        )
+        for goal_id, day in counters
+    ]
+    for start in range(0, len(operations), batch_size):
+        stats_collection.bulk_write(operations[start:start + batch_size], ordered=False)
+
+    print(f"Rebuilt {len(operations)} stats buckets")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Task database maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split = commands.add_parser("split-collections", help="Copy the old tasks collection into goals and subtasks")
+    split.add_argument("--batch-size", type=int, default=500, help="Legacy documents copied per batch")
+    split.add_argument("--reset", action="store_true", help="Forget saved progress and start from the beginning")
+
+    backfill = commands.add_parser("backfill-dates", help="Convert string dates into BSON dates")
+    backfill.add_argument("--batch-size", type=int, default=500, help="Documents converted per batch")
+    backfill.add_argument("--reset", action="store_true", help="Forget saved progress and start from the beginning")
+
+    history = commands.add_parser("migrate-history", help="Move embedded check-ins and notes into history buckets")
+    history.add_argument("--batch-size", type=int, default=200, help="Subtasks migrated per batch")
+    history.add_argument("--reset", action="store_true", help="Forget saved progress and start from the beginning")
+
+    normalize = commands.add_parser("normalize-subtasks", help="Repair subtask rows the listing cannot serve as stored")
+    normalize.add_argument("--batch-size", type=int, default=500, help="Subtasks checked per batch")
+
+    stats = commands.add_parser("backfill-stats", help="Rebuild the daily stats rollups from existing history")
+    stats.add_argument("--batch-size", type=int, default=500, help="Buckets written per batch")
+
+    args = parser.parse_args()
+    if args.command == "split-collections":
+        split_collections(args.batch_size, reset=args.reset)
+    elif args.command == "backfill-dates":
+        backfill_dates(args.batch_size, reset=args.reset)
+    elif args.command == "migrate-history":
+        migrate_history(args.batch_size, reset=args.reset)
+    elif args.command == "normalize-subtasks":
+        normalize_subtasks(args.batch_size)
+    elif args.command == "backfill-stats":
+        backfill_stats(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
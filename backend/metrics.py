@@ -0,0 +1,170 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+A deliberately small registry: labelled counters, gauges and histograms that
+are safe to update from any thread, rendered by the /metrics endpoint. The
+metrics themselves are defined at the bottom so every module records into
+the same instances.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from fast Mongo commands up to slow LLM replies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Tokens per LLM request, for comparing actual usage with the configured budgets
+TOKEN_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def copy_value(value):
+    """Snapshot a stored value so it can be rendered outside the lock."""
+    if isinstance(value, dict):
+        return {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+    return value
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base class holding one value per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((key, copy_value(value)) for key, value in self.values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the `with` block took, whether or not it raised."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render_value(self, key, series):
+        lines = []
+        for bound, count in zip(self.buckets + (float("inf"),), series["buckets"] + [series["count"]]):
+            le = 'le="' + format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {count}")
+        lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to produce a response, by route", ("method", "route", "status")
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command round trips", ("command", "collection")
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongo_command_failures_total", "MongoDB commands that returned an error", ("command", "collection")
+)
+LLM_REQUEST_DURATION = Histogram(
+    "llm_request_duration_seconds", "Duration of each LLM API request; retries and hedges count separately",
+    ("call_site", "outcome")
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by the LLM API", ("call_site", "kind"))
+LLM_ERRORS = Counter("llm_errors_total", "LLM calls that failed after retries", ("call_site", "error"))
+LLM_REQUEST_TOKENS = Histogram(
+    "llm_request_tokens", "Tokens used by each LLM request as reported by the API", ("call_site", "kind"),
+    buckets=TOKEN_BUCKETS
+)
+LLM_TRUNCATED = Counter("llm_truncated_total", "Replies cut off by the output token budget", ("call_site",))
+LLM_PROMPT_COMPACTIONS = Counter(
+    "llm_prompt_compactions_total", "Prompt fields shortened to fit the input token budget", ("call_site", "field")
+)
+JOB_DURATION = Histogram("job_duration_seconds", "Scheduler and background job run time", ("job",))
+SUBMISSIONS_COALESCED = Counter(
+    "submissions_coalesced_total", "Submissions answered with another request's response", ("route", "source")
+)
+SSE_CLIENTS = Gauge("sse_clients", "Connected /events clients")
+LLM_CIRCUIT_OPEN = Gauge("llm_circuit_open", "1 while the LLM circuit breaker is open or half-open")
@@ -0,0 +1,179 @@
+"""
+Token budgets and prompt compaction for LLM calls.
+
+Every call site has an input and an output budget in tokens. PromptBuilder
+fills a prompt template so that its estimated size stays within the input
+budget: fields are fitted in order of importance, long text is cut at a word
+boundary and lists lose their trailing items first. Check-in and note
+histories are reduced to a summary line plus the latest entries, so prompts
+stop growing with the age of a task. The output budget is applied as
+max_tokens by the LLM gateway.
+"""
+import logging
+import math
+import textwrap
+from collections import Counter
+from metrics import LLM_PROMPT_COMPACTIONS
+
+logger = logging.getLogger("pk-agent.prompts")
+
+# Tokens the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """
+    Estimate the token count of `text` without a tokenizer.
+
+    About four characters per token for ASCII text and one per character for
+    anything else (e.g. CJK), which errs on the high side for both.
+    """
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut `text` at a word boundary so it fits in `max_tokens`, marking the cut with an ellipsis."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 1:
+        return ""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) < max_tokens:  # Leave a token for the ellipsis
+            low = middle
+        else:
+            high = middle - 1
+    cut = text[:low]
+    space = cut.rfind(" ")
+    if space > low // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+
+class Field:
+    """
+    One value of a prompt template.
+
+    `value` is a string or a list of strings joined with `separator`, most
+    important item first. `max_tokens` caps the field even when the budget
+    has room; `empty` stands in for a missing value or empty list.
+    """
+
+    def __init__(self, name, value, max_tokens=None, separator="\n", empty="none"):
+        self.name = name
+        self.value = value
+        self.max_tokens = max_tokens
+        self.separator = separator
+        self.empty = empty
+
+    def fit(self, allowance):
+        """Return (text, trimmed): the value shortened to at most `allowance` tokens."""
+        if self.max_tokens is not None:
+            allowance = min(allowance, self.max_tokens)
+        if isinstance(self.value, (list, tuple)):
+            items = [str(item) for item in self.value if item]
+            if not items:
+                return self.empty, False
+            kept = []
+            for item in items:
+                candidate = self.separator.join(kept + [item])
+                if estimate_tokens(candidate) > allowance:
+                    break
+                kept.append(item)
+            if not kept:
+                return truncate_to_tokens(items[0], allowance), True
+            return self.separator.join(kept), len(kept) < len(items)
+
+        text = str(self.value) if self.value not in (None, "") else self.empty
+        fitted = truncate_to_tokens(text, allowance)
+        return fitted, fitted != text
+
+
+class PromptBuilder:
+    """
+    Build chat messages that respect each route's token budgets.
+
+    `budgets` maps a route name to {"input": tokens, "output": tokens}.
+    Templates are str.format strings; their indentation is removed, and
+    fields are fitted in the order given, so later fields get what the
+    earlier ones leave of the input budget.
+    """
+
+    def __init__(self, budgets, default_budget=None):
+        self.budgets = budgets
+        self.default_budget = default_budget or {"input": 1000, "output": 500}
+
+    def budget(self, route):
+        return self.budgets.get(route, self.default_budget)
+
+    def messages(self, route, template, fields=(), system=None):
+        """Return the messages for `route` with `template` filled in from `fields`."""
+        template = textwrap.dedent(template).strip()
+        available = self.budget(route)["input"] - MESSAGE_OVERHEAD_TOKENS
+        available -= estimate_tokens(template.format(**{field.name: "" for field in fields}))
+        if system:
+            available -= estimate_tokens(system) + MESSAGE_OVERHEAD_TOKENS
+
+        values = {}
+        for field in fields:
+            text, trimmed = field.fit(max(0, available))
+            values[field.name] = text
+            available -= estimate_tokens(text)
+            if trimmed:
+                LLM_PROMPT_COMPACTIONS.inc(call_site=route, field=field.name)
+        if available < 0:
+            logger.warning("Prompt exceeds its input budget", extra={"call_site": route, "over_by": -available})
+
+        messages = [{"role": "user", "content": template.format(**values)}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        return messages
+
+
+def summarize_history(check_ins=(), notes=(), counts=None, recent=3, reason_tokens=30):
+    """
+    Describe a task's check-ins and notes in a few short lines, newest first.
+
+    The first line summarizes the whole history, so it stays accurate when a
+    Field drops the older detail lines to fit the budget. Its counts by
+    status come from `counts` (the subtask's history_counts) when given, and
+    from the entries otherwise; reasons only come from the entries.
+    """
+    entries = []
+    for check_in in check_ins or []:
+        entries.append((str(check_in.get("timestamp", "")), check_in.get("status") or "check-in",
+                        " ".join(str(check_in.get("reason") or "").split())))
+    for note in notes or []:
+        entries.append((str(note.get("timestamp", "")), note.get("type") or "note",
+                        " ".join(str(note.get("reason") or "").split())))
+    if not entries and not counts:
+        return []
+    # ISO strings and datetimes both sort by their string form
+    entries.sort(key=lambda entry: entry[0], reverse=True)
+
+    if counts:
+        total = counts.get("check_in", 0) + counts.get("progress_note", 0)
+        statuses = Counter({
+            status: count for status, count in counts.items() if status not in ("check_in", "progress_note")
+        })
+    else:
+        total = len(entries)
+        statuses = Counter(status for _, status, _ in entries)
+    reasons = Counter(reason.lower() for _, _, reason in entries if reason)
+    summary = f"{total} updates so far (" + ", ".join(
+        f"{count} {status}" for status, count in statuses.most_common()
+    ) + ")"
+    if reasons:
+        summary += "; most frequent reasons: " + ", ".join(
+            f'"{truncate_to_tokens(reason, 10)}" ({count})' for reason, count in reasons.most_common(3)
+        )
+
+    lines = [summary]
+    for timestamp, status, reason in entries[:recent]:
+        line = f"{timestamp[:10]} {status}"
+        if reason:
+            line += f': "{truncate_to_tokens(reason, reason_tokens)}"'
+        lines.append(line)
+    return lines
@@ -0,0 +1,131 @@
+"""
+Daily rollups of productivity and procrastination statistics.
+
+The write paths that change what the dashboard shows (check-ins, completion
+toggles and procrastination reasons) also increment counters in a bucket per
+goal and day. /stats adds up the buckets of the requested period, so it
+reads one small document per goal and day instead of every subtask and its
+history.
+
+A bucket looks like
+    {"goal_id": ..., "day": "YYYY-MM-DD",
+     "counts": {"check_ins": 3, "completed": 1, ...},
+     "statuses": {"in_progress": 2, "procrastination": 1},
+     "reasons": {<key>: {"text": "too tired", "count": 1}}}
+where reasons are normalized and keyed by a hash of their text, since
+arbitrary text cannot be used as a field name.
+"""
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from storage import stats_collection
+from history import history_counter
+
+logger = logging.getLogger("pk-agent.stats")
+
+STATS_REASON_CHARS = 100  # Reasons are counted by their first characters, case and spacing ignored
+STATS_TOP_REASONS = 10
+
+
+def stats_day(at):
+    return at.strftime("%Y-%m-%d")
+
+
+def normalize_reason(reason):
+    return " ".join(str(reason or "").lower().split())[:STATS_REASON_CHARS]
+
+
+def stats_increments(counts=None, status=None, reason=None):
+    """
+    Return (increments, texts): the counters to add to a bucket, as dotted paths, and the reason texts to set.
+
+    `counts` maps counter names to increments, `status` is a check-in or note
+    status and `reason` the free text the user gave for it.
+    """
+    increments = {f"counts.{name}": value for name, value in (counts or {}).items()}
+    texts = {}
+    if status is not None:
+        increments[f"statuses.{history_counter({'status': status})}"] = 1
+    reason = normalize_reason(reason)
+    if reason:
+        key = hashlib.sha1(reason.encode()).hexdigest()[:16]
+        increments[f"reasons.{key}.count"] = 1
+        texts[f"reasons.{key}.text"] = reason
+    return increments, texts
+
+
+def stats_operation(goal_id, at=None, counts=None, status=None, reason=None):
+    """Build the upsert that adds one change to the bucket of `goal_id` for the day of `at`, or None if it counts nothing."""
+    increments, texts = stats_increments(counts, status, reason)
+    if not increments:
+        return None
+    update = {"$inc": increments}
+    if texts:
+        update["$set"] = texts
+    return UpdateOne({"goal_id": goal_id, "day": stats_day(at or datetime.now())}, update, upsert=True)
+
+
+def record_stats(*operations):
+    """
+    Apply stats_operation updates in one bulk write.
+
+    The task change they describe has already been stored, so a failure is
+    logged rather than raised: statistics may undercount, but the request
+    still succeeds.
+    """
+    operations = [operation for operation in operations if operation is not None]
+    if not operations:
+        return
+    try:
+        stats_collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Two first writes to a new bucket can race on its unique index; retry the losers once
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        try:
+            stats_collection.bulk_write([operations[index] for index in sorted(failed)], ordered=False)
+        except Exception as e:
+            logger.error("Error recording stats: %s", e)
+    except Exception as e:
+        logger.error("Error recording stats: %s", e)
+
+
+def read_stats(start_day, end_day, goal_id=None, top_reasons=STATS_TOP_REASONS):
+    """
+    Add up the buckets from `start_day` to `end_day` (inclusive, YYYY-MM-DD), optionally of one goal.
+
+    Returns the totals, check-in statuses, most frequent reasons and the
+    totals of each day that has any.
+    """
+    query = {"day": {"$gte": start_day, "$lte": end_day}}
+    if goal_id is not None:
+        query["goal_id"] = goal_id
+
+    totals = Counter()
+    statuses = Counter()
+    reasons = {}
+    days = {}
+    for bucket in stats_collection.find(query).sort("day", 1):
+        counts = bucket.get("counts", {})
+        totals.update(counts)
+        days.setdefault(bucket["day"], Counter()).update(counts)
+        statuses.update(bucket.get("statuses", {}))
+        for key, reason in bucket.get("reasons", {}).items():
+            entry = reasons.setdefault(key, {"reason": reason.get("text", ""), "count": 0})
+            entry["count"] += reason.get("count", 0)
+
+    return {
+        "totals": dict(totals),
+        "statuses": dict(statuses),
+        "top_reasons": sorted(reasons.values(), key=lambda entry: entry["count"], reverse=True)[:top_reasons],
+        "days": [{"day": day, **counts} for day, counts in days.items()]
+    }
+
+
+def completion_counts(was_completed, completed):
+    """The counters a change of a subtask's completion state adds: completed, reopened or nothing."""
+    if completed == was_completed:
+        return {}
+    return {"completed": 1} if completed else {"reopened": 1}
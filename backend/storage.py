@@ -0,0 +1,159 @@
+"""
+MongoDB connection, collections and shared write helpers.
+
+Kept free of Flask and background threads so that command-line tools such as
+manage.py can share the storage layer with the API.
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from pymongo import MongoClient, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError
+from metrics import MONGO_COMMAND_DURATION, MONGO_COMMAND_FAILURES
+
+# Load environment variables
+load_dotenv()
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Record the duration and outcome of every MongoDB command in the metrics registry."""
+
+    def __init__(self):
+        self.collections = {}  # (connection, request id) -> collection of a command in flight
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        # Most commands name their collection as the command's value; getMore names it separately
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "")
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        MONGO_COMMAND_DURATION.observe(
+            event.duration_micros / 1e6, command=event.command_name, collection=self.finish(event)
+        )
+
+    def failed(self, event):
+        collection = self.finish(event)
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, command=event.command_name, collection=collection)
+        MONGO_COMMAND_FAILURES.inc(command=event.command_name, collection=collection)
+
+    def finish(self, event):
+        with self.lock:
+            return self.collections.pop((event.connection_id, event.request_id), "")
+
+
+# Configure MongoDB client
+mongo_uri = os.getenv("MONGO_URI")
+mongo_client = MongoClient(mongo_uri, event_listeners=[CommandTimer()])
+db = mongo_client[os.getenv("MONGO_DB", "pk-agent")]  # Database name
+goals_collection = db["goals"]  # One document per user goal
+subtasks_collection = db["subtasks"]  # One document per subtask, linked by parent_goal_id
+legacy_tasks_collection = db["tasks"]  # Pre-split mixed goal/task documents, read only by migrations
+counters_collection = db["counters"]  # Monotonic sequence counters
+tombstones_collection = db["tombstones"]  # Records of deleted goals and subtasks
+llm_cache_collection = db["llm_cache"]  # Persistent tier of the LLM response cache
+jobs_collection = db["jobs"]  # Durable queue of background jobs
+migrations_collection = db["migrations"]  # Progress of resumable migrations
+idempotency_collection = db["idempotency_keys"]  # Responses replayed to retried submissions
+leases_collection = db["leases"]  # Leader election for work that must run in one process
+events_collection = db["events"]  # Capped relay of server-sent events between processes
+history_collection = db["history"]  # Buckets of subtask check-ins and progress notes
+stats_collection = db["stats_daily"]  # Statistics rolled up per goal and day
+
+LLM_CACHE_TTL = timedelta(days=7)
+IDEMPOTENCY_TTL = timedelta(hours=24)
+
+
+def ensure_indexes():
+    """Create the indexes the read paths rely on. Safe to call on every startup."""
+    goals_collection.create_index("updated_seq")
+    subtasks_collection.create_index("parent_goal_id")
+    # Subtasks stored by breakdown_goal carry their position, so a retried breakdown cannot store them twice
+    subtasks_collection.create_index(
+        [("parent_goal_id", 1), ("breakdown_index", 1)],
+        unique=True,
+        partialFilterExpression={"breakdown_index": {"$exists": True}}
+    )
+    subtasks_collection.create_index([("completed", 1), ("deadline", 1)])
+    subtasks_collection.create_index([("completed", 1), ("next_check_at", 1)])
+    subtasks_collection.create_index("status")
+    subtasks_collection.create_index("updated_seq")
+    tombstones_collection.create_index("seq")
+    llm_cache_collection.create_index("created_at", expireAfterSeconds=int(LLM_CACHE_TTL.total_seconds()))
+    jobs_collection.create_index([("status", 1), ("created_at", 1)])
+    history_collection.create_index([("subtask_id", 1), ("count", 1)])
+    history_collection.create_index([("subtask_id", 1), ("last_at", -1)])
+    stats_collection.create_index([("goal_id", 1), ("day", 1)], unique=True)
+    stats_collection.create_index("day")
+    idempotency_collection.create_index("created_at", expireAfterSeconds=int(IDEMPOTENCY_TTL.total_seconds()))
+
+
+def insert_documents(collection, documents):
+    """
+    Store several documents with a single unordered insert_many.
+
+    Returns (inserted, failures): the documents that were stored, with their
+    _id filled in, and a list of {"index": ..., "error": ...} entries for the
+    ones that were not. One bad document does not stop the rest of the batch.
+    """
+    if not documents:
+        return [], []
+    try:
+        collection.insert_many(documents, ordered=False)
+        return documents, []
+    except BulkWriteError as e:
+        errors = {error["index"]: error.get("errmsg", "Write failed") for error in e.details.get("writeErrors", [])}
+        inserted = [document for index, document in enumerate(documents) if index not in errors]
+        failures = [{"index": index, "error": errors[index]} for index in sorted(errors)]
+        return inserted, failures
+
+
+def next_change_seq():
+    """
+    Allocate the next value of the global change sequence.
+
+    Every write stamps the documents it touches with `updated_seq`, which lets
+    clients fetch only what changed since a given token and lets list
+    endpoints derive their ETags from the rows changed most recently.
+    """
+    counter = counters_collection.find_one_and_update(
+        {"_id": "changes"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+
+def current_change_seq():
+    """Return the latest allocated change sequence without incrementing it."""
+    counter = counters_collection.find_one({"_id": "changes"})
+    return counter["seq"] if counter else 0
+
+
+def parse_deadline(value):
+    """
+    Parse a deadline (datetime, ISO-8601 string or YYYY-MM-DD) into a naive local datetime.
+
+    Deadlines are stored as BSON dates; strings only come from model output,
+    query arguments and documents written before the date backfill.
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            try:
+                parsed = datetime.strptime(value.strip(), "%Y-%m-%d")
+            except ValueError:
+                return None
+    else:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
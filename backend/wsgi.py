@@ -0,0 +1,15 @@
+"""
+Production entry point for a multi-process WSGI server:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Every worker process serves requests and runs background job workers. One
+process at a time, elected through a lease in MongoDB, runs the scheduled
+jobs and the check-in waker; if it dies, another takes over once the lease
+expires. Server-sent events are relayed between the workers through MongoDB.
+"""
+import os
+from app import create_app
+
+# Threads per worker, as configured in gunicorn.conf.py; /events streams may hold only a share of them
+app = create_app(multiprocess=True, worker_threads=int(os.getenv("GUNICORN_THREADS", "16")))
@@ -1,6 +1,6 @@
 "use client"; // Mark this as a Client Component
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 
 interface Subtask {
   _id: string;
@@ -35,6 +35,7 @@ export default function Home() {
   const [checkInReason, setCheckInReason] = useState("");
   const [showCheckIn, setShowCheckIn] = useState(false);
   const [lastFetchTime, setLastFetchTime] = useState(0);
+  const [dueCheckIn, setDueCheckIn] = useState<string | null>(null);
 
   // Function to handle task submission
   const handleSubmit = async (e: React.FormEvent) => {
@@ -154,6 +155,53 @@ export default function Home() {
     }
   };
 
+  // Token from the last sync; polls only ask for what changed after it
+  const syncTokenRef = useRef<string | null>(null);
+
+  // Walk the paginated /subtasks listing until the backend stops returning a cursor
+  const fetchSubtaskPages = async (since: string | null) => {
+    const data: Subtask[] = [];
+    let deleted: string[] = [];
+    let syncToken: string | null = null;
+    let cursor: string | null = null;
+    do {
+      const url = new URL("http://127.0.0.1:5000/subtasks");
+      if (cursor) {
+        url.searchParams.set("cursor", cursor);
+      }
+      if (since) {
+        url.searchParams.set("since", since);
+      }
+
+      const response = await fetch(url.toString(), {
+        method: 'GET',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+      });
+
+      if (!response.ok) {
+        throw new Error(`Failed to fetch subtasks: ${response.statusText}`);
+      }
+
+      const page = await response.json();
+      data.push(...page.subtasks);
+      deleted = deleted.concat(page.deleted || []);
+      // The first page's token covers every later page of the same listing
+      syncToken = syncToken ?? page.sync_token;
+      cursor = page.next_cursor;
+    } while (cursor);
+
+    return { data, deleted, syncToken };
+  };
+
+  // Sort tasks by deadline
+  const sortByDeadline = (items: Subtask[]) => items.sort((a: Subtask, b: Subtask) => {
+    const dateA = new Date(a.deadline);
+    const dateB = new Date(b.deadline);
+    return dateA.getTime() - dateB.getTime();
+  });
+
   // Function to fetch subtasks from the backend
   const fetchSubtasks = async (retry = false) => {
     // Prevent multiple fetches within 2 seconds
@@ -169,27 +217,10 @@ export default function Home() {
       setIsLoadingSubtasks(true);
       setLastFetchTime(now);
       
-      const response = await fetch("http://127.0.0.1:5000/subtasks", {
-        method: 'GET',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      });
-
-      if (!response.ok) {
-        throw new Error(`Failed to fetch subtasks: ${response.statusText}`);
-      }
-
-      const data = await response.json();
-      
-      // Sort tasks by deadline
-      const sortedSubtasks = data.sort((a: Subtask, b: Subtask) => {
-        const dateA = new Date(a.deadline);
-        const dateB = new Date(b.deadline);
-        return dateA.getTime() - dateB.getTime();
-      });
+      const { data, syncToken } = await fetchSubtaskPages(null);
 
-      setSubtasks(sortedSubtasks);
+      setSubtasks(sortByDeadline(data));
+      syncTokenRef.current = syncToken;
       console.log("Successfully updated subtasks state");
       
     } catch (error) {
@@ -201,15 +232,52 @@ export default function Home() {
     }
   };
 
+  // Function to merge only the subtasks that changed since the last sync
+  const syncSubtasks = async () => {
+    if (!syncTokenRef.current) {
+      return fetchSubtasks();
+    }
+
+    try {
+      const { data, deleted, syncToken } = await fetchSubtaskPages(syncTokenRef.current);
+      syncTokenRef.current = syncToken;
+      if (data.length === 0 && deleted.length === 0) {
+        return;
+      }
+
+      const changedIds = new Set(data.map(subtask => subtask._id));
+      const deletedIds = new Set(deleted);
+      setSubtasks(prev => sortByDeadline([
+        ...prev.filter(subtask => !changedIds.has(subtask._id) && !deletedIds.has(subtask._id)),
+        ...data,
+      ]));
+      console.log(`Synced ${data.length} changed and ${deleted.length} deleted subtasks`);
+    } catch (error) {
+      console.error("Error syncing subtasks:", error);
+    }
+  };
+
   // Fetch subtasks on component mount
   useEffect(() => {
     fetchSubtasks(true);
   }, []);
 
-  // Refresh subtasks every minute
+  // Listen for pushed task events instead of polling
   useEffect(() => {
-    const interval = setInterval(fetchSubtasks, 60 * 1000);
-    return () => clearInterval(interval);
+    const events = new EventSource("http://127.0.0.1:5000/events");
+
+    // Catch up on anything missed while the stream was disconnected
+    events.onopen = () => syncSubtasks();
+    events.addEventListener("subtasks_generated", () => syncSubtasks());
+    events.addEventListener("task_toggled", () => syncSubtasks());
+    events.addEventListener("resync", () => syncSubtasks());
+    events.addEventListener("check_in_due", (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      console.log("Check-in due:", data);
+      setDueCheckIn(data.task);
+    });
+
+    return () => events.close();
   }, []);
 
   return (
@@ -239,6 +307,19 @@ export default function Home() {
           </div>
         </form>
 
+        {/* Check-in Reminder */}
+        {dueCheckIn && (
+          <div className="mb-6 flex items-center justify-between p-4 bg-blue-50 text-blue-800 rounded-lg">
+            <p>Time to check in on: <span className="font-medium">{dueCheckIn}</span></p>
+            <button
+              onClick={() => setDueCheckIn(null)}
+              className="px-3 py-1 text-sm bg-blue-100 rounded hover:bg-blue-200 transition-colors"
+            >
+              Dismiss
+            </button>
+          </div>
+        )}
+
         {/* Task List */}
         <div className="space-y-6">
           {isLoadingSubtasks ? (